@@ -32,8 +32,16 @@ MA.SampleLogLoad = function() {
     sampleLogStore.load({ params: { sample__experiment__id__exact: MA.ExperimentController.currentId() } });
 };
 
-MA.SampleLogSuccess = function() {
-    MA.SampleLoadByExperiment();
+MA.SampleLogSuccess = function(response) {
+    // only the logged samples need their status refreshing
+    var rows = response.responseJSON.rows;
+    for (var idx = 0; idx < rows.length; idx++) {
+        var record = randomisableSampleStore.getById(rows[idx].id);
+        if (record && rows[idx].success) {
+            record.set('last_status', rows[idx].last_status);
+            record.commit();
+        }
+    }
     MA.SampleLogLoad();
 };
 
@@ -1,6 +1,14 @@
 import datetime
 import os
+import sys
+import io
+import bz2
+import zlib
+import tarfile
+import threading
+import Queue
 import zipfile
+import zipstream
 import json
 from decimal import Decimal
 from django.core.serializers.json import DateTimeAwareJSONEncoder
@@ -200,41 +208,122 @@ def jsonResponse(data={}, items=None, mainContentFunction=None, params=None):
     retdata = json.dumps(retval)
     return HttpResponse(retdata)
 
-class ZipPacker(object):
+# Instrument files which are compressed already, and which would only
+# cost CPU time to deflate again.
+ZIP_STORED_EXTENSIONS = ('.zip', '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.7z')
+
+# Size of the pieces in which file data is read into a package.
+PACKAGE_CHUNK_SIZE = 64 * 1024
 
-    def pack(self, files, filename):
-        import zipfile
-        zipf = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
-        for f, n in files:
-            if os.path.isfile(f):
-                zipf.write(f, n)
-            elif os.path.isdir(f):
-                for (archiveDirPath, dirNames, fileNames) in os.walk(f):
-                    for fileName in fileNames:
-                        filePath = os.path.join(archiveDirPath, fileName)
-                        archive_name = os.path.join(n, fileName)
-                        zipf.write(filePath, archive_name)
-
-        zipf.close()
-        return filename
+def walk_package_files(files):
+    """
+    Expands a list of (filename, arcname) pairs into the directories
+    and files which make up the package, in order. Directories are
+    followed by everything inside them. An empty arcname puts the
+    contents of a directory at the top of the package.
+    """
+    for f, n in files:
+        if f is None or not os.path.lexists(f):
+            continue
+        if n:
+            yield f, n
+        if os.path.isdir(f) and not os.path.islink(f):
+            for (archiveDirPath, dirNames, fileNames) in os.walk(f):
+                dirNames.sort()
+                relDir = os.path.relpath(archiveDirPath, f)
+                for name in dirNames + sorted(fileNames):
+                    yield (os.path.join(archiveDirPath, name),
+                           os.path.normpath(os.path.join(n, relDir, name)))
+
+class ZipPacker(object):
+    """
+    Streams a zip package. Files are deflated unless compress is
+    False or they are compressed already.
+    """
+    def __init__(self, compress=True):
+        self.compress = compress
+
+    def stream(self, files):
+        compression = zipstream.ZIP_DEFLATED if self.compress else zipstream.ZIP_STORED
+        zipped = zipstream.ZipFile(mode="w", compression=compression, allowZip64=True)
+        for f, n in walk_package_files(files):
+            if os.path.isdir(f):
+                # only empty directories need their own entries
+                if not os.listdir(f):
+                    zipped.write(f, n)
+            elif f.lower().endswith(ZIP_STORED_EXTENSIONS):
+                zipped.write(f, n, zipstream.ZIP_STORED)
+            else:
+                zipped.write(f, n)
+        return zipped
 
 class TarPacker(object):
+    """
+    Streams a tar package, compressed with gzip or bzip2 if asked.
+    The archive is generated a block at a time, so big files don't
+    have to fit in memory.
+    """
     def __init__(self, compression=None):
         assert compression is None or compression in ('gz','bz2'), "Invalid compression type"
         self.compression = compression
 
-    def pack(self, files, filename):
-        import tarfile
-        mode = 'w'
-        if self.compression is not None:
-            mode = "%s:%s" % (mode, self.compression)
-        tar = tarfile.open(filename, mode)
-        for f, n in files:
-            tar.add(f, n)
-        tar.close()
-        return filename
-
-def guess_package_type(filename):
+    def _compressor(self):
+        if self.compression == 'gz':
+            # wbits of 16 + MAX_WBITS gives gzip output
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif self.compression == 'bz2':
+            return bz2.BZ2Compressor(9)
+        return None
+
+    def stream(self, files):
+        compressor = self._compressor()
+        for data in self._tar_blocks(files):
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.flush()
+
+    def _tar_blocks(self, files):
+        # the TarFile is only used to make headers, nothing is written to it
+        tar = tarfile.open(fileobj=io.BytesIO(), mode="w")
+        offset = 0
+        for f, n in walk_package_files(files):
+            tarinfo = tar.gettarinfo(f, n)
+            if tarinfo is None:
+                continue # sockets etc. can't be archived
+            header = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+            offset += len(header)
+            yield header
+            if tarinfo.isreg():
+                for data in self._file_data(f, tarinfo.size):
+                    offset += len(data)
+                    yield data
+
+        # end of archive marker, padded out to a whole record
+        end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        remainder = (offset + len(end)) % tarfile.RECORDSIZE
+        if remainder:
+            end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+        yield end
+
+    def _file_data(self, filename, size):
+        "Reads size bytes of the file, padded out to a whole tar block."
+        remaining = size
+        with open(filename, "rb") as fp:
+            while remaining > 0:
+                data = fp.read(min(remaining, PACKAGE_CHUNK_SIZE))
+                if not data:
+                    # the file shrank since it was looked at
+                    data = tarfile.NUL * min(remaining, PACKAGE_CHUNK_SIZE)
+                remaining -= len(data)
+                yield data
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+def guess_package_type(filename, compress=True):
     def endswithany(s, sa):
         for end in sa:
             if s.endswith(end):
@@ -248,19 +337,77 @@ def guess_package_type(filename):
     elif endswithany(filename, ('.tbz2', '.tar.bz2')):
         packer = TarPacker(compression='bz2')
     elif filename.endswith('zip'):
-        packer = ZipPacker()
+        packer = ZipPacker(compress=compress)
 
     return packer
 
-def pack_files(files, package_name):
-    import tempfile
-    packer = guess_package_type(package_name)
+def stream_package(files, package_name, compress=True, threaded=False):
+    """
+    Returns an iterator over the chunks of a package of files, in the
+    format given by the package name's extension. If threaded is
+    True, the package is built in a worker thread so that compressing
+    it overlaps with sending it.
+    """
+    packer = guess_package_type(package_name, compress)
     assert packer is not None, 'Invalid package type for ' + package_name
-    dummy, filename = tempfile.mkstemp()
-    print "FILENAME: " + filename
-    package_path = packer.pack(files, filename)
+    chunks = packer.stream(files)
+    if threaded:
+        chunks = threaded_iter(chunks)
+    return chunks
 
-    return package_path
+# How often a blocked worker checks whether it should stop, in seconds.
+THREADED_ITER_POLL = 0.5
+
+def threaded_iter(iterable, max_chunks=16):
+    """
+    Runs through the iterable in a worker thread, handing on its items
+    as they're needed. At most max_chunks items are held waiting. The
+    worker is only started once the first item is asked for, and it
+    stops, closing the iterable, if this iterator is closed or garbage
+    collected before the end.
+    """
+    items = Queue.Queue(max_chunks)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=THREADED_ITER_POLL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((False, item)):
+                    return
+        except Exception:
+            put((True, sys.exc_info()))
+        else:
+            put((True, None))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+
+    def consume():
+        worker = threading.Thread(target=produce, name="threaded_iter")
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                done, item = items.get()
+                if done:
+                    if item is not None:
+                        raise item[0], item[1], item[2]
+                    return
+                yield item
+        finally:
+            stopped.set()
+
+    return consume()
 
 def zipdir(dirPath=None, zipFilePath=None, includeDirInZip=True):
 
@@ -295,3 +442,16 @@ def zipdir(dirPath=None, zipFilePath=None, includeDirInZip=True):
             outFile.writestr(zipInfo, "")
 
     outFile.close()
+
+def zipstream_dir(dirPath, includeDirInZip=True, compress=True):
+    """
+    Like zipdir, but returns a zipstream which produces the archive
+    as it is iterated over, so it can be streamed to the client
+    without writing it to disk first.
+    """
+    if not os.path.isdir(dirPath):
+        raise OSError("dirPath argument must point to a directory. "
+            "'%s' does not." % dirPath)
+    dirPath = os.path.normpath(dirPath)
+    arcname = os.path.basename(dirPath) if includeDirInZip else ""
+    return ZipPacker(compress).stream([(dirPath, arcname)])
@@ -0,0 +1,119 @@
+import os
+import re
+import urllib
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.encoding import smart_bytes
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from django.views.static import was_modified_since
+
+# Size of the pieces in which files are sent.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def file_response(request, realfile, filename=None, content_type='application/download'):
+    """
+    Sends a file as an attachment, in constant memory. Conditional
+    and Range requests are answered using the file's ETag and
+    Last-Modified date, so an interrupted download can be resumed.
+
+    If settings.DOWNLOAD_SENDFILE is set, the web server is asked to
+    send the file instead, and it deals with the ranges itself.
+    """
+    if filename is None:
+        filename = os.path.basename(realfile)
+
+    st = os.stat(realfile)
+    etag = quote_etag("%x-%x-%x" % (st.st_ino, st.st_size, int(st.st_mtime)))
+    last_modified = http_date(st.st_mtime)
+
+    if not_modified(request, etag, st.st_mtime, st.st_size):
+        response = HttpResponseNotModified()
+    elif settings.DOWNLOAD_SENDFILE:
+        response = sendfile_response(realfile, content_type)
+    else:
+        byte_range = requested_range(request, etag, last_modified, st.st_size)
+        if byte_range is None:
+            response = StreamingHttpResponse(read_file(realfile, 0, st.st_size),
+                                             content_type=content_type)
+            response['Content-Length'] = st.st_size
+        elif byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % st.st_size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_file(realfile, start, end - start + 1),
+                                             content_type=content_type, status=206)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, st.st_size)
+            response['Content-Length'] = end - start + 1
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    if response.status_code != 304:
+        response['Content-Disposition'] = 'attachment;  filename=\"%s\"' % filename
+    return response
+
+def not_modified(request, etag, mtime, size):
+    "Whether the client's copy of the file is still current."
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.strip('"') in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        return not was_modified_since(if_modified_since, mtime, size)
+    return False
+
+def requested_range(request, etag, last_modified, size):
+    """
+    Returns the (first, last) byte positions asked for by the Range
+    header, None if the whole file should be sent, or False if the
+    range can't be satisfied. Only single ranges are supported.
+    """
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if not match or match.group(1) == match.group(2) == '' or size == 0:
+        return None
+
+    # the range only applies if the client has the current file
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        if parse_http_date_safe(if_range) is None or if_range != last_modified:
+            return None
+
+    first, last = match.groups()
+    if first == '':
+        # the last bytes of the file
+        if int(last) == 0:
+            return False
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start > end:
+            return False if start >= size else None
+    return start, end
+
+def read_file(filename, start, length, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    "Reads length bytes of the file from start, a chunk at a time."
+    with open(filename, "rb") as fp:
+        fp.seek(start)
+        while length > 0:
+            data = fp.read(min(length, chunk_size))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+def sendfile_response(realfile, content_type):
+    "Has the web server send the file, with X-Sendfile or X-Accel-Redirect."
+    response = HttpResponse(content_type=content_type)
+    # the web server is given the path as UTF-8 bytes
+    realfile = smart_bytes(os.path.abspath(realfile))
+    if settings.DOWNLOAD_SENDFILE == 'x-accel-redirect':
+        prefix = smart_bytes(settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/'))
+        response['X-Accel-Redirect'] = urllib.quote(prefix + realfile)
+    else:
+        response['X-Sendfile'] = realfile
+    return response
@@ -2,13 +2,44 @@ import os
 import os.path
 import stat
 import grp
+import time
 from django.conf import settings
+try:
+    # reads the file types along with the names, where the OS allows
+    from scandir import scandir
+except ImportError:
+    scandir = None
 import logging
 LOGNAME = 'mastrms.general'
 logger = logging.getLogger(LOGNAME)
+
+# Repo directories which this process has already created and given
+# the right ownership, mapped to the time that was done. Until the
+# entry expires, ensuring one of these directories again costs a
+# single stat.
+_ensured_dirs = {}
+
 def ensure_repo_filestore_dir_with_owner(relpath, ownerid=os.getuid(), groupname=settings.CHMOD_GROUP):
     '''helper function to create directories within the mastrms permanent filestore, with the correct perms'''
+    abspath = repo_filestore_abspath(relpath)
+    if is_ensured_repo_dir(abspath):
+        return
+
     logger.debug('ensuring repo path %s' % (relpath) )
+    try:
+        if not os.path.exists(abspath):
+            logger.debug('creating directory: %s' % ( abspath ) )
+            os.makedirs(abspath)
+
+        owned = set_repo_file_ownerships(abspath, ownerid=ownerid, groupname=groupname)
+    except Exception, e:
+        logger.critical('Exception in ensure_repo_filestore_dir_with_owner: %s' % (e))
+        raise
+
+    if owned:
+        _ensured_dirs[abspath] = time.time()
+
+def repo_filestore_abspath(relpath):
     #the input should be a relative path.
     #if it does start with a /, check to see if it is the REPO_FILES_ROOT and chop that out.
     #otherwise chop off the leading /
@@ -18,20 +49,27 @@ def ensure_repo_filestore_dir_with_owner(relpath, ownerid=os.getuid(), groupname
         else:
             relpath = os.path.normpath(relpath).split(os.sep, 1)[1] #chop off leading /
 
-    abspath = os.path.join(settings.REPO_FILES_ROOT, relpath)
-    try:
-        if not os.path.exists(abspath):
-            logger.debug('creating directory: %s' % ( abspath ) )
-            os.makedirs(abspath)
+    return os.path.join(settings.REPO_FILES_ROOT, relpath)
 
-        set_repo_file_ownerships(abspath, ownerid=ownerid, groupname=groupname)
-    except Exception, e:
-        logger.critical('Exception in ensure_repo_filestore_dir_with_owner: %s' % (e))
-        raise
+def is_ensured_repo_dir(abspath):
+    """
+    Returns True if this process recently ensured the directory and it
+    is still there.
+    """
+    ensured = _ensured_dirs.get(abspath)
+    if ensured is None:
+        return False
+    if time.time() - ensured > settings.REPO_DIR_CACHE_TTL or not os.path.isdir(abspath):
+        _ensured_dirs.pop(abspath, None)
+        return False
+    return True
 
-    clean_temp_files(abspath)
+def forget_ensured_repo_dirs():
+    "Empties the cache of ensured directories."
+    _ensured_dirs.clear()
 
-def set_repo_file_ownerships(filepath, ownerid=os.getuid(), groupname=settings.CHMOD_GROUP):
+def set_repo_file_ownerships(filepath, ownerid=os.getuid(), groupname=settings.CHMOD_GROUP,
+                             mode=stat.S_IRWXU|stat.S_IRWXG):
     try:
         groupinfo = grp.getgrnam(groupname)
     except KeyError:
@@ -41,7 +79,7 @@ def set_repo_file_ownerships(filepath, ownerid=os.getuid(), groupname=settings.C
     gid = groupinfo.gr_gid
 
     try:
-        os.chmod(filepath, stat.S_IRWXU|stat.S_IRWXG)
+        os.chmod(filepath, mode)
     except OSError, e:
         logger.critical("Unable to set permissions: %s" % str(e))
         return False
@@ -55,19 +93,45 @@ def set_repo_file_ownerships(filepath, ownerid=os.getuid(), groupname=settings.C
 
     return True
 
-def clean_temp_files(repodir):
+# Directory listings mapped to the mtime the directory had when it was
+# read. An unchanged directory can then be listed again with a single
+# stat.
+_dir_listings = {}
+DIR_LISTING_CACHE_SIZE = 1000
+
+def list_dir(path):
     """
-    Just in case the client happens to upload temp files, get rid of
-    them here.
+    Returns the (filename, is_dir) pairs for the entries of a
+    directory which this process can read, sorted by filename.
+    Raises OSError if the directory can't be read.
     """
-    targets = set(["TEMPBASE", "TEMPDAT", "TEMPDIR"])
-    istemp = lambda f: f in targets
-
-    for root, dirs, files in os.walk(repodir):
-        for name in filter(istemp, files):
-            path = os.path.join(root, name)
-            logger.info("Deleting temp file %s" % path)
-            try:
-                os.remove(path)
-            except EnvironmentError, e:
-                logger.error(e)
+    mtime = os.stat(path).st_mtime
+    cached = _dir_listings.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    entries = sorted(_scan_dir(path))
+
+    # The mtime may have too coarse a resolution to show changes
+    # made straight after this listing, so recent ones aren't cached.
+    if time.time() - mtime > 2:
+        if len(_dir_listings) >= DIR_LISTING_CACHE_SIZE:
+            _dir_listings.clear()
+        _dir_listings[path] = (mtime, entries)
+
+    return entries
+
+def _scan_dir(path):
+    if scandir is not None:
+        for entry in scandir(path):
+            if os.access(entry.path, os.R_OK):
+                yield entry.name, entry.is_dir()
+    else:
+        for filename in os.listdir(path):
+            filepath = os.path.join(path, filename)
+            if os.access(filepath, os.R_OK):
+                yield filename, os.path.isdir(filepath)
+
+def forget_dir_listings():
+    "Empties the cache of directory listings."
+    _dir_listings.clear()
@@ -9,10 +9,13 @@ from mastrms.repository.runbuilder import RunBuilder
 from mastrms.testutils import *
 from mdatasync_client.Simulator import Simulator
 import tempfile
+import json
 import time
+from datetime import datetime, timedelta
 import logging
 import os
 import pipes
+import shutil
 import re
 import dingus
 from contextlib import contextmanager
@@ -77,3 +80,200 @@ class DeleteTempFilesTests(TestCase):
 
         for f in self.temp_files:
             self.assertFalse(os.path.exists(f), "%s doesn't exist" % f)
+
+@override_settings(REPO_FILES_ROOT=TESTING_REPO)
+class ExpectedFilesTests(WithRun, TestCase):
+    """
+    Tests the file manifest which is sent to datasync clients by
+    `getExpectedFilesForNode`.
+    """
+
+    def setUp(self):
+        self.nc = NodeClient.objects.create(organisation_name="org",
+                                            site_name="site",
+                                            station_name="station")
+        self.setup_run(machine=self.nc)
+        sclass = SampleClass.objects.create(class_id="CLS",
+                                            experiment=self.experiment)
+        self.runsamples = []
+        for i in range(5):
+            sample = Sample.objects.create(sample_class=sclass,
+                                           experiment=self.experiment,
+                                           label="sample%d" % i)
+            self.runsamples.append(RunSample.objects.create(
+                run=self.run, sample=sample, filename="sample%d.d" % i))
+        self.blank = RunSample.objects.create(run=self.run,
+                                              component_id=RunSample.SWEEP_ID,
+                                              filename="sweep.d")
+
+        def cleanup_repo():
+            for name in os.listdir(TESTING_REPO):
+                shutil.rmtree(os.path.join(TESTING_REPO, name))
+        self.addCleanup(cleanup_repo)
+
+    def test_manifest(self):
+        from mastrms.mdatasync_server.views import getExpectedFilesForNode
+
+        self.experiment.ensure_dir()
+        os.mkdir(os.path.join(self.experiment.experiment_dir, "sample1.d"))
+
+        expected = getExpectedFilesForNode(self.nc)
+        files = expected["incomplete"][self.run.id]
+
+        self.assertEqual(expected["complete"], {})
+        self.assertEqual(len(files), 6)
+        self.assertEqual(files["sample0.d"], [self.run.id, self.runsamples[0].id,
+                                              self.experiment.experiment_subdir, False])
+        self.assertEqual(files["sample1.d"], [self.run.id, self.runsamples[1].id,
+                                              self.experiment.experiment_subdir, True])
+        self.assertEqual(files["sweep.d"], [self.run.id, self.blank.id,
+                                            self.run.run_subdir, False])
+
+    def test_manifest_completed_runs(self):
+        from mastrms.mdatasync_server.views import getExpectedFilesForNode
+
+        RunSample.objects.filter(id=self.runsamples[0].id).update(complete=True)
+        Run.objects.filter(id=self.run.id).update(state=RUN_STATES.COMPLETE[0])
+
+        expected = getExpectedFilesForNode(self.nc)
+        self.assertEqual(expected, {"complete": {}, "incomplete": {}})
+
+        expected = getExpectedFilesForNode(self.nc, include_completed=True)
+        self.assertEqual(expected["complete"][self.run.id].keys(), ["sample0.d"])
+        self.assertEqual(len(expected["incomplete"][self.run.id]), 5)
+
+    def test_manifest_query_count(self):
+        from mastrms.mdatasync_server.views import getExpectedFilesForNode
+
+        # a single query, however many runsamples there are
+        with self.assertNumQueries(1):
+            getExpectedFilesForNode(self.nc)
+
+    def test_changed_files(self):
+        from mastrms.mdatasync_server.views import getChangedFilesForNode, make_sync_token, parse_sync_token
+
+        full_sync, since = parse_sync_token(make_sync_token())
+        files, removed = getChangedFilesForNode(self.nc, since)
+        self.assertEqual(len(files), 6)
+        self.assertEqual(removed, [])
+
+        # nothing has changed since a long time after the runsamples were saved
+        later = datetime.now() + timedelta(hours=1)
+        self.assertEqual(getChangedFilesForNode(self.nc, later), ({}, []))
+
+        RunSample.objects.filter(id=self.runsamples[0].id).update(complete=True, last_modified=later)
+        RunSample.objects.filter(id=self.runsamples[1].id).update(filename="renamed.d", last_modified=later)
+        files, removed = getChangedFilesForNode(self.nc, later)
+        self.assertEqual(files.keys(), ["renamed.d"])
+        self.assertEqual(removed, [self.runsamples[0].id])
+
+        files, removed = getChangedFilesForNode(self.nc, later, include_completed=True)
+        self.assertEqual(sorted(files.keys()), ["renamed.d", "sample0.d"])
+        self.assertEqual(removed, [])
+
+    def test_check_run_sample_files(self):
+        from mastrms.mdatasync_server.views import check_run_sample_files_exist, mark_run_samples_complete
+
+        self.experiment.ensure_dir()
+        for rs in self.runsamples[:2]:
+            os.mkdir(os.path.join(self.experiment.experiment_dir, rs.filename))
+        posted = {str(self.run.id): [rs.id for rs in self.runsamples[:3]] + [999]}
+
+        with self.assertNumQueries(1):
+            found, missing, unknown = check_run_sample_files_exist(posted)
+        self.assertEqual(sorted(found.keys()), [rs.id for rs in self.runsamples[:2]])
+        self.assertEqual(missing.keys(), [self.runsamples[2].id])
+        self.assertEqual(unknown, [999])
+
+        mark_run_samples_complete(found, missing)
+        run = Run.objects.get(id=self.run.id)
+        self.assertEqual(run.complete_sample_count, 2)
+        self.assertEqual(run.incomplete_sample_count, 4)
+        self.assertEqual(RunSample.objects.filter(complete=True).count(), 2)
+
+    def test_sync_token(self):
+        from mastrms.mdatasync_server.views import make_sync_token, parse_sync_token, SYNC_TOKEN_FORMAT
+
+        self.assertEqual(parse_sync_token(None), None)
+        self.assertEqual(parse_sync_token("garbage"), None)
+        stale = datetime.now() - timedelta(days=2)
+        self.assertEqual(parse_sync_token(stale.strftime(SYNC_TOKEN_FORMAT)), None)
+
+        # incremental syncs keep the time of the last full sync
+        full_sync = datetime.now() - timedelta(hours=1)
+        self.assertEqual(parse_sync_token(make_sync_token(full_sync))[0], full_sync)
+        self.assertEqual(parse_sync_token(make_sync_token(stale)), None)
+
+    def request_sync(self, sync_token=None):
+        from django.test.client import RequestFactory
+        from mastrms.mdatasync_server.views import request_sync
+        data = {"version": "1.5"}
+        if sync_token:
+            data["sync_token"] = sync_token
+        request = RequestFactory().post("/", data)
+        return json.loads(request_sync(request, "org", "site", "station").content)
+
+    def test_sync_deletions(self):
+        """
+        Deleted runsamples and runs moved to another machine don't
+        show up in incremental syncs, so once the last full sync is
+        too old the client is sent the full manifest again, however
+        often it has polled since.
+        """
+        from mastrms.mdatasync_server import views
+        def at(when):
+            return dingus.patch("mastrms.mdatasync_server.views.datetime", dingus.Dingus(
+                now=dingus.Dingus(return_value=when), strptime=datetime.strptime))
+
+        now = datetime.now()
+        with at(now - views.SYNC_TOKEN_MAX_AGE + timedelta(hours=1)):
+            resp = self.request_sync()
+        self.assertFalse(resp["incremental"])
+        self.assertEqual(len(resp["files"]), 6)
+
+        other = Run.objects.create(experiment=self.experiment, method=self.run.method,
+                                   creator=self.run.creator, machine=self.nc)
+        RunSample.objects.create(run=other, filename="other.d")
+        self.runsamples[0].delete()
+
+        with at(now):
+            resp = self.request_sync(resp["sync_token"])
+        self.assertTrue(resp["incremental"])
+        self.assertIn("other.d", resp["files"])
+        # the deletion can't be seen in the changes
+        self.assertEqual(resp["removed"], [])
+
+        Run.objects.filter(id=other.id).update(machine=NodeClient.objects.create(
+            organisation_name="org", site_name="site", station_name="other"))
+
+        with at(now + timedelta(hours=2)):
+            resp = self.request_sync(resp["sync_token"])
+        self.assertFalse(resp["incremental"])
+        self.assertEqual(sorted(resp["files"].keys()),
+                         ["sample%d.d" % i for i in range(1, 5)] + ["sweep.d"])
+
+class ServeFileTests(TestCase):
+    """
+    Tests that `serve_file` only serves the persistent filestore.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="testfilestore-")
+        self.addCleanup(shutil.rmtree, self.root)
+        with open(os.path.join(self.root, "file.txt"), "w") as f:
+            f.write("contents")
+        from django.test.client import RequestFactory
+        self.request = RequestFactory().get("/")
+        self.request.user = User.objects.create(email="files@example.com")
+
+    def test_filestore(self):
+        from mastrms.mdatasync_server.views import serve_file
+        with self.settings(PERSISTENT_FILESTORE=self.root):
+            response = serve_file(self.request, "file.txt")
+            self.assertEqual("".join(response.streaming_content), "contents")
+
+    def test_no_filestore(self):
+        from django.http import Http404
+        from mastrms.mdatasync_server.views import serve_file
+        with self.settings(PERSISTENT_FILESTORE=None, REPO_FILES_ROOT=self.root):
+            self.assertRaises(Http404, serve_file, self.request, "file.txt")
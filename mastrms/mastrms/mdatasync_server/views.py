@@ -10,12 +10,14 @@ from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+from django.db import transaction
 from django.core.mail import EmailMessage
 from ccg_django_utils import webhelpers
 from mastrms.mdatasync_server.models import *
 from mastrms.repository.models import *
 from mastrms.mdatasync_server.rules import *
 from mastrms.app.utils.file_utils import ensure_repo_filestore_dir_with_owner, set_repo_file_ownerships
+from mastrms.app.utils.download_utils import file_response
 
 import logging
 logger = logging.getLogger("mastrms.mdatasync_server")
@@ -92,11 +94,20 @@ def request_sync(request, organisation=None, sitename=None, station=None):
        version is acceptable, then go through the experiments which the node
        is involved in, and send back a list of files it wants.
 
+       If the client also sends back the sync_token from its previous
+       request, only the files which changed since then are sent, and
+       "incremental" is set in the response. The client should then
+       merge "files" into the list it already has, and drop the
+       runsample ids listed in "removed".
+
        The return format is:
        {
             files: {},
+            removed: [],
             runsamples: {},
             details{},
+            sync_token: "" (to be sent with the next request)
+            incremental: T/F
             success: T/F (set to False if no node or version check fails)
             message: "" (a message to explain problems if success is false)
 
@@ -106,10 +117,14 @@ def request_sync(request, organisation=None, sitename=None, station=None):
     resp = {"success": False,
             "message": "",
             "files": {},
+            "removed": [],
             "details":{},
-            "runsamples":{}}
+            "runsamples":{},
+            "sync_token": None,
+            "incremental": False}
     syncold = request.GET.get("sync_completed", False)
     logger.debug('syncold is: %s' % syncold)
+    synced = parse_sync_token(request.POST.get("sync_token", None))
     if node is not None:
         ncerror, nodeclient_details = get_nodeclient_details(organisation, sitename, station)
         resp["details"] = nodeclient_details
@@ -118,6 +133,16 @@ def request_sync(request, organisation=None, sitename=None, station=None):
             resp["message"] = "Client version \"%s\" is not supported. Please update." % version
         else:
             resp["success"] = True
+            if synced is not None:
+                #only the changes since the client's last request
+                full_sync, since = synced
+                resp["sync_token"] = make_sync_token(full_sync)
+                resp["files"], resp["removed"] = getChangedFilesForNode(node, since, include_completed=syncold)
+                resp["incremental"] = True
+                return HttpResponse(json.dumps(resp))
+
+            resp["sync_token"] = make_sync_token()
+
             #now get the runs for that nodeclient
             expectedFiles = getExpectedFilesForNode(node, include_completed=syncold)
             expectedincomplete = expectedFiles['incomplete']
@@ -187,30 +212,129 @@ def getExpectedFilesForNode(nodeclient, include_completed = False):
     incomplete = {}
     complete = {}
 
-    #now get the runs for that nodeclient
-    runs = Run.objects.filter(machine = nodeclient)
-    for run in runs:
-        logger.debug('Finding runsamples for run')
-        if not run.is_complete() or include_completed:
-            runsamples = run.runsample_set.exclude(filename="")
-            runsamples = runsamples.exclude(filename__isnull=True) # fixme: fix the model
+    #now get the runsamples for all of that nodeclient's runs in one query
+    runsamples = RunSample.objects.filter(run__machine=nodeclient)
+    if not include_completed:
+        runsamples = runsamples.exclude(run__state=RUN_STATES.COMPLETE[0])
+    runsamples = runsamples.exclude(filename="")
+    runsamples = runsamples.exclude(filename__isnull=True) # fixme: fix the model
+    runsamples = runsamples.select_related("run", "run__experiment").order_by("run", "id")
 
-            #Build a filesdict of all the files for these runsamples
-            for rs in runsamples:
-                logger.debug('Getting files for runsamples');
+    #Each experiment or run directory is ensured and listed once,
+    #rather than once per runsample.
+    listings = DirectoryListings()
 
-                target_dict = complete if rs.complete else incomplete
+    #Build a filesdict of all the files for these runsamples
+    for rs in runsamples:
+        target_dict = complete if rs.complete else incomplete
 
-                abspath, relpath = rs.filepaths()
-                runfiles = target_dict.setdefault(run.id, {})
+        abspath, relpath = listings.filepaths(rs)
+        runfiles = target_dict.setdefault(rs.run_id, {})
 
-                if runfiles.has_key(rs.filename):
-                    logger.warning( 'Duplicate filename detected for %s' % (rs.filename.encode('utf-8')))
+        if runfiles.has_key(rs.filename):
+            logger.warning( 'Duplicate filename detected for %s' % (rs.filename.encode('utf-8')))
 
-                runfiles[rs.filename] = [run.id, rs.id, relpath, os.path.exists(os.path.join(abspath, rs.filename))]
+        runfiles[rs.filename] = [rs.run_id, rs.id, relpath, listings.exists(abspath, rs.filename)]
 
     return {'complete': complete, 'incomplete': incomplete}
 
+def getChangedFilesForNode(nodeclient, since, include_completed = False):
+    """
+    Returns the changes to the nodeclient's expected files made after
+    the datetime `since', as a tuple of (files, removed).
+
+    files is a dict of the files which are now wanted, in the same
+    format as the entries of getExpectedFilesForNode(). removed is a
+    list of ids of runsamples which are no longer wanted, because they
+    were completed or their filename was cleared.
+    """
+    files = {}
+    removed = []
+
+    runsamples = RunSample.objects.filter(run__machine=nodeclient, last_modified__gte=since)
+    runsamples = runsamples.select_related("run", "run__experiment").order_by("run", "id")
+
+    listings = DirectoryListings()
+
+    for rs in runsamples:
+        wanted = include_completed or not (rs.complete or rs.run.state == RUN_STATES.COMPLETE[0])
+        if wanted and rs.filename:
+            abspath, relpath = listings.filepaths(rs)
+            files[rs.filename] = [rs.run_id, rs.id, relpath, listings.exists(abspath, rs.filename)]
+        else:
+            removed.append(rs.id)
+
+    return files, removed
+
+# Sync tokens hold the server time of the client's last full manifest
+# and the time at which the latest manifest or changes were made.
+# Changes are looked for from a little before the latter, so that
+# runsamples saved by transactions which were still open at the time
+# aren't missed. The full manifest time is carried over by incremental
+# syncs, and once it is too old the client is sent the full manifest
+# again. That picks up anything the change times can't show, such as
+# deleted runsamples or runs moved to another machine.
+SYNC_TOKEN_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+SYNC_TOKEN_MARGIN = timedelta(minutes=1)
+SYNC_TOKEN_MAX_AGE = timedelta(days=1)
+
+def make_sync_token(full_sync=None):
+    """
+    Makes the token for a manifest made now. full_sync is the time of
+    the last full manifest, if this is an incremental one.
+    """
+    now = datetime.now()
+    return "%s/%s" % ((full_sync or now).strftime(SYNC_TOKEN_FORMAT),
+                      now.strftime(SYNC_TOKEN_FORMAT))
+
+def parse_sync_token(token):
+    """
+    Returns (time of the last full manifest, time from which changes
+    should be sent) for the token, or None if a full manifest should
+    be sent instead.
+    """
+    if not token:
+        return None
+    try:
+        full_sync, issued = [datetime.strptime(t, SYNC_TOKEN_FORMAT) for t in token.split("/")]
+    except ValueError:
+        logger.warning("Invalid sync token: %s" % token)
+        return None
+    if datetime.now() - full_sync > SYNC_TOKEN_MAX_AGE:
+        return None
+    return full_sync, issued - SYNC_TOKEN_MARGIN
+
+class DirectoryListings(object):
+    """
+    Remembers the storage directory of each experiment and run, along
+    with the names in it, so that checking many runsample files costs
+    one directory read per directory instead of one stat per file.
+    """
+    def __init__(self):
+        self._paths = {}
+        self._names = {}
+
+    def filepaths(self, rs):
+        "Same as RunSample.filepaths(), but only once per directory."
+        if rs.is_sample():
+            key = ("experiment", rs.run.experiment_id)
+        else:
+            key = ("run", rs.run_id)
+        if key not in self._paths:
+            self._paths[key] = rs.filepaths()
+        return self._paths[key]
+
+    def exists(self, abspath, filename):
+        if os.sep in filename:
+            # not a direct child of the directory, so stat it
+            return os.path.exists(os.path.join(abspath, filename))
+        if abspath not in self._names:
+            try:
+                self._names[abspath] = set(os.listdir(unicode(abspath)))
+            except EnvironmentError:
+                self._names[abspath] = set()
+        return filename in self._names[abspath]
+
 
 def get_nodeclient_details(organisation_name, site_name, station_name):
     nodeclient_details = {}
@@ -244,20 +368,6 @@ def get_nodeclient_details(organisation_name, site_name, station_name):
     return error, nodeclient_details
 
 
-def check_run_sample_file_exists(runsampleid):
-    ''' Checks that the file for a given runsampleid is present in the filesystem'''
-    fileexists = False
-    try:
-        rs = RunSample.objects.get(id=runsampleid)
-        abssamplepath, relsamplepath = rs.filepaths()
-        complete_filename = os.path.join(abssamplepath, rs.filename)
-        fileexists = os.path.exists(complete_filename)
-        logger.debug( 'Checking file %s:%s' % (complete_filename.encode('utf-8'), fileexists) )
-    except Exception, e:
-        logger.debug('Could not check runsample file for runsampleid: %s: %s' % (str(runsampleid), e))
-
-    return fileexists
-
 @csrf_exempt
 def check_run_sample_files(request):
     ret = {}
@@ -268,41 +378,66 @@ def check_run_sample_files(request):
         runsamplefilesdict = json.loads(runsamplefilesjson)
         # so now we have a dict keyed on run, of sample id's whose file should have been received.
         logger.debug('Checking run samples against: %s' % ( runsamplefilesdict) )
-        # We iterate through each run, get the samples referred to, and ensure their file exists on disk.
-        ret['description'] = ""
-        totalruns = 0
-        totalsamples = 0
-        totalfound = 0
-
         ret['success'] = True
         ret['description'] = 'Success'
         ret['error'] = 'None'
         ret['synced_samples'] = {}
-        for runid in runsamplefilesdict.keys():
-            totalruns += 1
-            ret['synced_samples'][runid] = []
-            logger.debug('Checking files from run %s' % str(runid) )
-            runsamples = runsamplefilesdict[runid]
-            for runsample in runsamples:
-                totalsamples +=1
-                runsample = int(runsample)
-                try:
-                    rs = RunSample.objects.get(id = runsample)
-                    rs.complete = check_run_sample_file_exists(runsample)
-                    if rs.complete:
-                        totalfound += 1
-                        ret['synced_samples'][runid].append(rs.id)
-                    rs.save()
-                except Exception, e:
-                    logger.debug('Error: %s' % (e) )
-                    ret['success'] = False
-                    ret['error'] = "%s" % (str(e))
-        ret['description'] = "%s - %d/%d samples marked complete, from %d run(s)" % (ret['description'], totalfound, totalsamples, totalruns)
+
+        with transaction.atomic():
+            found, missing, unknown = check_run_sample_files_exist(runsamplefilesdict)
+
+            for runid, runsamples in runsamplefilesdict.iteritems():
+                ret['synced_samples'][runid] = [int(rs) for rs in runsamples if int(rs) in found]
+
+            if unknown:
+                logger.debug('Error: unknown runsample ids %s' % unknown)
+                ret['success'] = False
+                ret['error'] = "RunSample matching query does not exist: %s" % ", ".join(map(str, unknown))
+
+            mark_run_samples_complete(found, missing)
+
+        totalsamples = len(found) + len(missing) + len(unknown)
+        ret['description'] = "%s - %d/%d samples marked complete, from %d run(s)" % (ret['description'], len(found), totalsamples, len(runsamplefilesdict))
     else:
         ret['description'] = "No files given"
 
     return jsonResponse(ret)
 
+def check_run_sample_files_exist(runsamplefilesdict):
+    """
+    Checks which of the runsamples in a dict of lists of runsample ids
+    keyed on run have their file present in the filesystem.
+    Returns a tuple of (found, missing, unknown), where found and missing
+    map runsample ids to their RunSample, and unknown is a list of the
+    ids which don't exist.
+    """
+    ids = set(int(rs) for runsamples in runsamplefilesdict.itervalues() for rs in runsamples)
+    runsamples = RunSample.objects.select_related("run", "run__experiment").in_bulk(ids)
+
+    listings = DirectoryListings()
+    found, missing = {}, {}
+    for rs in runsamples.itervalues():
+        abspath, relpath = listings.filepaths(rs)
+        exists = listings.exists(abspath, rs.filename)
+        logger.debug('Checking file %s:%s' % (os.path.join(abspath, rs.filename).encode('utf-8'), exists))
+        (found if exists else missing)[rs.id] = rs
+
+    return found, missing, sorted(ids.difference(runsamples))
+
+def mark_run_samples_complete(found, missing):
+    """
+    Sets the complete flag of runsamples according to whether their
+    file was found, then refreshes the sample counts of their runs.
+    Only rows whose flag changes are touched.
+    """
+    now = datetime.now()
+    RunSample.objects.filter(id__in=found.keys(), complete=False).update(complete=True, last_modified=now)
+    RunSample.objects.filter(id__in=missing.keys(), complete=True).update(complete=False, last_modified=now)
+
+    runs = dict((rs.run_id, rs.run) for rs in found.values() + missing.values())
+    for run in runs.itervalues():
+        run.update_sample_counts()
+
 @csrf_exempt
 def log_upload(request, *args):
     logger.debug('LOGUPLOAD')
@@ -479,17 +614,19 @@ def tail_log(request, filename=None, linesback=10, since=0):
 
 @login_required
 def serve_file(request, path):
-    root = settings.PERSISTENT_FILESTORE
+    # Only the persistent filestore is served from here. The
+    # repository's files are downloaded through views which check the
+    # user's access to the experiment or run.
+    root = getattr(settings, 'PERSISTENT_FILESTORE', None)
+    if not root:
+        raise Http404, 'No file store is configured'
     path = posixpath.normpath(urllib.unquote(path))
     path = path.lstrip('/')
     fullpath = os.path.join(root, path)
-    if not os.path.isfile(fullpath):
+    if path.startswith('..') or not os.path.isfile(fullpath):
         raise Http404, '"%s" does not exist' % fullpath
-    contents = open(fullpath, 'rb').read()
     mimetype = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
-    response = HttpResponse(contents, mimetype=mimetype)
-    response["Content-Length"] = len(contents)
-    return response
+    return file_response(request, fullpath, content_type=mimetype)
 
 def set_log_level(newlevel):
     success = True
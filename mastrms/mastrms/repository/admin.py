@@ -7,6 +7,7 @@ from django.http import HttpResponseRedirect
 from ccg_django_utils.webhelpers import url
 from django.core import urlresolvers
 from django.db.models import Q
+from datetime import datetime
 
 from mastrms.users.models import getCurrentUser
 
@@ -365,7 +366,7 @@ class RunAdmin(ExtJsonInterface, admin.ModelAdmin):
         # Go through each selected run and set its samples to incomplete
         runsamples = RunSample.objects.filter(run__in=queryset, complete=True)
         nsamples = runsamples.count()
-        runsamples.update(complete=False)
+        runsamples.update(complete=False, last_modified=datetime.now())
 
         # Notify user
         nob = lambda n, ob: "%d %s%s" % (n, ob, "" if n == 1 else "s")
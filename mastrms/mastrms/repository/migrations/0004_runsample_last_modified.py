@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repository', '0003_reference_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='runsample',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, auto_now=True, db_index=True),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repository', '0004_runsample_last_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sample',
+            name='last_log',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, editable=False, to='repository.SampleLog', null=True),
+        ),
+        migrations.RunSQL(
+            ["""
+            UPDATE repository_sample SET last_log_id =
+                (SELECT l.id FROM repository_samplelog l WHERE l.sample_id = repository_sample.id
+                 ORDER BY l.changetimestamp DESC, l.id DESC LIMIT 1)
+            """],
+            migrations.RunSQL.noop),
+    ]
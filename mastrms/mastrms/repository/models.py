@@ -2,18 +2,21 @@
 import grp
 import os
 from datetime import datetime, date, time
-from itertools import chain
+from itertools import chain, groupby
+from contextlib import contextmanager
+import threading
 import re
 from urllib import urlencode
 import logging
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models.signals import post_delete
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from mastrms.quote.models import Organisation, Formalquote
 from mastrms.mdatasync_server.models import NodeClient
 from mastrms.users.models import User
-from mastrms.app.utils.file_utils import ensure_repo_filestore_dir_with_owner
+from mastrms.app.utils.file_utils import ensure_repo_filestore_dir_with_owner, is_ensured_repo_dir
 
 logger = logging.getLogger('mastrms.general')
 
@@ -247,6 +250,11 @@ class Experiment(models.Model):
         Creates all the experiment storage directories if they don't
         exist, and sets their permissions.
         """
+        # nothing to do if this process has already set them up
+        if (is_ensured_repo_dir(self.experiment_dir) and
+            is_ensured_repo_dir(self.other_files_dir)):
+            return self.experiment_dir
+
         other_dirs = ["Project Background", "Data Processing", "Bioinformatics Analysis", "Report"]
 
         # filter the other_dirs to remove ones which exist somewhere
@@ -256,7 +264,7 @@ class Experiment(models.Model):
                       for subdir in other_dirs
                       if subdir not in existing_dirs]
 
-        for dir in [self.experiment_dir] + other_dirs:
+        for dir in [self.experiment_dir] + other_dirs + [self.other_files_dir]:
             try:
                 ensure_repo_filestore_dir_with_owner(dir)
             except Exception, e:
@@ -385,6 +393,32 @@ class SampleClass(models.Model):
             val = 'class_' + str(self.id)
         return val
 
+    @classmethod
+    def renumber_samples(cls, experiment_id):
+        """
+        Numbers the samples of each of the experiment's classes from 1,
+        keeping their order.
+        """
+        if connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE %(sample)s AS s SET sample_class_sequence = ordered.sequence
+                FROM (SELECT id, row_number() OVER (PARTITION BY sample_class_id
+                                                    ORDER BY sample_class_sequence, id) AS sequence
+                      FROM %(sample)s WHERE sample_class_id IN
+                          (SELECT id FROM %(sampleclass)s WHERE experiment_id = %%s)) AS ordered
+                WHERE s.id = ordered.id AND s.sample_class_sequence <> ordered.sequence
+                """ % {"sample": Sample._meta.db_table, "sampleclass": cls._meta.db_table},
+                [experiment_id])
+        else:
+            samples = Sample.objects.filter(sample_class__experiment__id=experiment_id)
+            samples = samples.order_by("sample_class_id", "sample_class_sequence", "id")
+            rows = samples.values_list("id", "sample_class", "sample_class_sequence")
+            for sample_class, group in groupby(rows, lambda row: row[1]):
+                for sequence, (sample_id, sample_class, old_sequence) in enumerate(group, 1):
+                    if sequence != old_sequence:
+                        Sample.objects.filter(id=sample_id).update(sample_class_sequence=sequence)
+
 class Sample(models.Model):
     sample_id = models.CharField(max_length=255)
     sample_class = models.ForeignKey(SampleClass, null=True, blank=True)
@@ -393,6 +427,9 @@ class Sample(models.Model):
     comment = models.TextField(blank=True)
     weight = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
     sample_class_sequence = models.SmallIntegerField(default=1, db_index=True)
+    # the most recent log entry, kept up to date by SampleLog
+    last_log = models.ForeignKey('SampleLog', null=True, blank=True, editable=False,
+                                 on_delete=models.SET_NULL, related_name='+')
 
     def __unicode__(self):
         return u"%s-%s" % (self.sample_class.class_id if self.sample_class else "",
@@ -412,6 +449,29 @@ class Sample(models.Model):
         '''Test to determine whether this sample can be used in a run'''
         return bool(self.sample_class and self.sample_class.enabled)
 
+    @property
+    def last_status(self):
+        return unicode(self.last_log) if self.last_log_id else u''
+
+    @classmethod
+    def update_last_logs(cls, sample_ids):
+        """
+        Points the samples at their latest log entry, in a single
+        statement. Needed after logs are bulk created or deleted.
+        """
+        sample_ids = list(sample_ids)
+        if not sample_ids:
+            return
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE %(sample)s SET last_log_id =
+                (SELECT l.id FROM %(samplelog)s l WHERE l.sample_id = %(sample)s.id
+                 ORDER BY l.changetimestamp DESC, l.id DESC LIMIT 1)
+            WHERE id IN (%(ids)s)
+            """ % {"sample": cls._meta.db_table, "samplelog": SampleLog._meta.db_table,
+                   "ids": ", ".join(["%s"] * len(sample_ids))},
+            sample_ids)
+
 class RUN_STATES:
     NEW = (0, u"New")
     IN_PROGRESS = (1, u"In Progress")
@@ -425,6 +485,45 @@ class RUN_STATES:
         return ''
 
 
+SAMPLE_COUNT_AGGREGATES = {
+    "total": models.Count("id"),
+    "incomplete": models.Sum(models.Case(models.When(complete=False, then=models.Value(1)),
+                                         default=models.Value(0),
+                                         output_field=models.IntegerField())),
+}
+
+# Runs whose sample counts are waiting to be updated, for each thread
+# inside a deferred_sample_counts() block.
+_deferred_counts = threading.local()
+
+@contextmanager
+def deferred_sample_counts():
+    """
+    Within this block, saving or deleting a RunSample doesn't recount
+    the samples of its run. Instead, every run which was touched is
+    recounted once, when the outermost block exits without error.
+    The block runs in a transaction, so if it fails its changes are
+    rolled back rather than left with stale counts.
+    """
+    outermost = getattr(_deferred_counts, "runs", None) is None
+    if outermost:
+        _deferred_counts.runs = {}
+    try:
+        with transaction.atomic():
+            yield
+            if outermost:
+                Run.update_sample_counts_for(_deferred_counts.runs.values())
+    finally:
+        if outermost:
+            _deferred_counts.runs = None
+
+def sample_counts_changed(run):
+    runs = getattr(_deferred_counts, "runs", None)
+    if runs is None:
+        run.update_sample_counts()
+    else:
+        runs[run.id] = run
+
 class Run(models.Model):
 
     RUN_STATES_TUPLES = (
@@ -471,41 +570,83 @@ class Run(models.Model):
         #this run - it still means that samples could have been added in randomised or arbitrary order,
         #and that will be maintained (because runsamples are created to reflect that order).
         logger.debug('resequencing samples')
-        sequence = 1
-        for rs in RunSample.objects.filter(run=self).order_by("id"):
-            rs.sequence = sequence
-            sequence += 1
-            rs.save()
+        if connection.vendor == 'postgresql':
+            # number the rows with a window function, in a single statement
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE %(table)s AS rs SET sequence = ordered.sequence
+                FROM (SELECT id, row_number() OVER (ORDER BY id) AS sequence
+                      FROM %(table)s WHERE run_id = %%s) AS ordered
+                WHERE rs.id = ordered.id AND rs.sequence <> ordered.sequence
+                """ % {"table": RunSample._meta.db_table}, [self.id])
+        else:
+            ids = RunSample.objects.filter(run=self).order_by("id").values_list("id", "sequence")
+            for sequence, (rs_id, old_sequence) in enumerate(ids, 1):
+                if sequence != old_sequence:
+                    RunSample.objects.filter(id=rs_id).update(sequence=sequence)
         logger.debug('finished resequencing samples')
 
     def add_samples(self, sampleslist):
-        '''Takes a list of samples'''
+        '''Takes a list of samples, and adds the ones which aren't already in the run, in order'''
         logger.debug('add_samples started')
         assert self.id, 'Run must have an id before samples can be added'
-        for s in sampleslist:
-            if s.is_valid_for_run():
-                logger.debug( 'add_samples adding %d' % (s.id) )
-                rs, created = RunSample.objects.get_or_create(run=self, sample=s)
-        self.resequence_samples()
+        with transaction.atomic():
+            existing = set(RunSample.objects.filter(run=self).values_list("sample_id", flat=True))
+            new_runsamples = []
+            for s in sampleslist:
+                if s.id not in existing and s.is_valid_for_run():
+                    logger.debug( 'add_samples adding %d' % (s.id) )
+                    new_runsamples.append(RunSample(run=self, sample=s))
+                    existing.add(s.id)
+            RunSample.objects.bulk_create(new_runsamples)
+            self.resequence_samples()
+            sample_counts_changed(self)
         logger.debug("add_samples complete")
 
     def remove_samples(self, queryset):
         assert self.id, 'Run must have an id before samples can be added'
-        for s in queryset:
-            RunSample.objects.filter(run=self, sample=s).delete()
-        self.resequence_samples()
+        with transaction.atomic():
+            RunSample.objects.filter(run=self, sample__in=queryset).delete()
+            self.resequence_samples()
+            sample_counts_changed(self)
 
     def update_sample_counts(self):
-        qs = RunSample.objects.filter(run=self)
+        counts = RunSample.objects.filter(run=self).aggregate(**SAMPLE_COUNT_AGGREGATES)
+        self._set_sample_counts(counts["total"], counts["incomplete"])
+        self.save()
 
-        self.sample_count = qs.count()
-        self.incomplete_sample_count = qs.filter(complete=False).count()
+    def _set_sample_counts(self, total, incomplete):
+        self.sample_count = total
+        self.incomplete_sample_count = incomplete or 0
         self.complete_sample_count = self.sample_count - self.incomplete_sample_count
 
         if self.complete_sample_count == self.sample_count:
             self.state = RUN_STATES.COMPLETE[0]
 
-        self.save()
+    @classmethod
+    def update_sample_counts_for(cls, runs):
+        """
+        Recounts the samples of many runs with one aggregate query.
+        Only the count fields (and the state, if the run is now
+        complete) are written, so stale run instances can be passed.
+        """
+        runs = dict((run.id, run) for run in runs)
+        if not runs:
+            return
+        qs = RunSample.objects.filter(run__in=runs.keys()).values("run")
+        counts = dict((c["run"], c) for c in qs.annotate(**SAMPLE_COUNT_AGGREGATES))
+
+        for run_id, run in runs.iteritems():
+            c = counts.get(run_id, {"total": 0, "incomplete": 0})
+            run._set_sample_counts(c["total"], c["incomplete"])
+            fields = {
+                "sample_count": run.sample_count,
+                "incomplete_sample_count": run.incomplete_sample_count,
+                "complete_sample_count": run.complete_sample_count,
+            }
+            if run.state == RUN_STATES.COMPLETE[0]:
+                fields["state"] = run.state
+            Run.objects.filter(id=run_id).update(**fields)
 
     @property
     def run_dir(self):
@@ -563,6 +704,18 @@ class SampleLog(models.Model):
     def __unicode__(self):
         return "%s: %s" % (self.LOG_TYPES[self.type][1], self.description)
 
+    def save(self, *args, **kwargs):
+        super(SampleLog, self).save(*args, **kwargs)
+        # changetimestamp is auto_now, so this is now the latest entry
+        Sample.objects.filter(id=self.sample_id).update(last_log=self)
+
+def samplelog_deleted(sender, instance, **kwargs):
+    # A signal rather than SampleLog.delete(), so that queryset and
+    # admin deletes also point the sample back at its previous log.
+    Sample.update_last_logs([instance.sample_id])
+
+post_delete.connect(samplelog_deleted, sender=SampleLog)
+
 class UserInvolvementType(models.Model):
     """Principal Investigator or Involved User"""
     name = models.CharField(max_length=25)
@@ -590,6 +743,8 @@ class RunSample(models.Model):
     sequence = models.PositiveIntegerField(null=False, default=0)
     vial_number = models.PositiveIntegerField(null=True, blank=True)
     method_number = models.PositiveIntegerField(null=True, blank=True)
+    # used to send data sync clients only the files which changed
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     @classmethod
     def create_sweep(self, run):
@@ -612,11 +767,11 @@ class RunSample(models.Model):
     def delete(self, *args, **kwargs):
         run = self.run
         super(RunSample, self).delete(*args, **kwargs)
-        run.update_sample_counts()
+        sample_counts_changed(run)
 
     def save(self, *args, **kwargs):
         super(RunSample, self).save(*args, **kwargs)
-        self.run.update_sample_counts()
+        sample_counts_changed(self.run)
 
     def filepaths(self):
         if self.is_sample():
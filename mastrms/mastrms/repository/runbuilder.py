@@ -1,6 +1,9 @@
-from mastrms.repository.models import RunSample, RUN_STATES, SampleNotInClassException, InstrumentSOP
+from mastrms.repository.models import RunSample, RUN_STATES, SampleNotInClassException, InstrumentSOP, Component, deferred_sample_counts, sample_counts_changed
+from django.db import transaction
+from django.db.models import Case, When, Value
 from django.http import HttpResponse
 import random
+from datetime import datetime
 
 class RunBuilderException(Exception):
     pass
@@ -8,11 +11,26 @@ class RunBuilderException(Exception):
 class RunBuilder(object):
     def __init__(self, run):
         self.run = run
+        self._runsamples = None
+
+    def runsamples(self):
+        """
+        Returns the run's RunSamples, with everything needed to make
+        their filenames loaded in one query.
+        """
+        if self._runsamples is None:
+            qs = RunSample.objects.filter(run=self.run)
+            qs = qs.select_related("sample", "sample__sample_class", "component")
+            self._runsamples = list(qs)
+            for rs in self._runsamples:
+                rs.run = self.run
+        return self._runsamples
 
     def validate(self):
         if self.run.rule_generator is None:
             raise Exception("runs captured from outside mastr-ms cannot be built")
-        for sample in self.run.samples.distinct():
+        samples = dict((rs.sample_id, rs.sample) for rs in self.runsamples() if rs.sample_id is not None)
+        for sample in samples.itervalues():
             sample.run_filename(self.run)
 
     def layout(self):
@@ -22,6 +40,7 @@ class RunBuilder(object):
         layout = RunLayout(self.run)
         layout.perform_layout()
         #end result of a perform_layout is new RunSample entries to represent all other line items
+        self._runsamples = None
 
     def generate(self):
         try:
@@ -31,61 +50,71 @@ class RunBuilder(object):
         except SampleNotInClassException, e:
             raise RunBuilderException('Samples in the run need to be in sample classes before they can be used in a run')
 
-        if self.run.state == RUN_STATES.NEW[0]:
-            self.layout()
+        #the sample counts are updated once, after the run is saved
+        with deferred_sample_counts():
+            if self.run.state == RUN_STATES.NEW[0]:
+                self.layout()
 
-        #write filenames into DB
-        for rs in RunSample.objects.filter(run=self.run):
-            rs.filename = rs.generate_filename()
-            rs.save()
+            #write filenames into DB
+            runsamples = self.runsamples()
+            for rs in runsamples:
+                rs.filename = rs.generate_filename()
+            update_runsamples(runsamples, "filename")
 
-        #mark the run as in-progress and save it
-        if self.run.state == RUN_STATES.NEW[0]:
-            self.run.state = RUN_STATES.IN_PROGRESS[0]
-            self.run.save()
+            #mark the run as in-progress and save it
+            if self.run.state == RUN_STATES.NEW[0]:
+                self.run.state = RUN_STATES.IN_PROGRESS[0]
+                self.run.save()
 
-class RunLayout(object):
-    def __init__(self, run):
+class WorklistLayout(object):
+    """
+    Lays out a worklist of samples along with the standards, blanks
+    and sweeps required by a rule generator. The items are unsaved
+    RunSamples, and nothing is written to the database, so this can
+    be used to preview what a rule generator does.
+    """
+    def __init__(self, rule_generator, number_of_methods=None, order_of_methods=None, run=None):
+        self.rule_generator = rule_generator
+        self.number_of_methods = number_of_methods
+        self.order_of_methods = order_of_methods
         self.run = run
+        self._blank_components = {}
 
-    def perform_layout(self):
-        self.delete_nonsample_run_samples()
-
+    def layout(self, samples):
+        "Returns the worklist items for the samples, in order."
         start_block = self.create_start_block()
-        sample_block = self.create_sample_block()
+        sample_block = self.create_sample_block(samples)
         end_block = self.create_end_block()
 
         items = start_block + sample_block + end_block
-        if self.run.rule_generator.apply_sweep_rule:
+        if self.rule_generator.apply_sweep_rule:
             items = self.add_sweeps(items)
 
-        self.save_items(items)
+        for seq, item in enumerate(items):
+            item.sequence = seq+1
+        return items
 
-    def delete_nonsample_run_samples(self):
-        # Deletes all the RunSamples that aren't Samples (ie. Standards, Blanks etc.)
-        RunSample.objects.filter(run=self.run, component__id__gt=0).delete()
-        # TODO another reason the generator should generate a clean worklist in a different DB table
-        # We have to ensure that only method 1 Samples are kept and method_number is resetted to None
-        RunSample.objects.filter(run=self.run, method_number__gt=1).delete()
-        RunSample.objects.filter(run=self.run, method_number=1).update(method_number=None)
+    def new_item(self, **kwargs):
+        if self.run is not None:
+            kwargs["run"] = self.run
+        return RunSample(**kwargs)
 
     def create_start_block(self):
         start_block = []
-        for rule in self.run.rule_generator.start_block_rules:
+        for rule in self.rule_generator.start_block_rules:
             for i in range(rule.count):
-                start_block.append(RunSample.create(self.run, rule.component))
+                start_block.append(self.new_item(component=rule.component))
         return start_block
 
     def create_end_block(self):
         end_block = []
-        for rule in self.run.rule_generator.end_block_rules:
+        for rule in self.rule_generator.end_block_rules:
             for i in range(rule.count):
-                end_block.append(RunSample.create(self.run, rule.component))
+                end_block.append(self.new_item(component=rule.component))
         return end_block
 
-    def create_sample_block(self):
-        samples = list(self.run.runsample_set.filter(component__id=0).order_by('sequence'))
-        insertion_map = self.create_insertion_map(samples, self.run.rule_generator.sample_block_rules)
+    def create_sample_block(self, samples):
+        insertion_map = self.create_insertion_map(samples, self.rule_generator.sample_block_rules)
         sample_block = self.combine(samples, insertion_map)
         sample_block = self.apply_method_rules(sample_block)
         return sample_block
@@ -103,7 +132,7 @@ class RunLayout(object):
                     position = random.randint(start+1, end)
                 arr = insertion_map.setdefault(position, [])
                 for i in range(rule.count):
-                    arr.append(RunSample.create(self.run, rule.component))
+                    arr.append(self.new_item(component=rule.component))
         return insertion_map
 
     def combine(self, samples, insertion_map):
@@ -117,37 +146,137 @@ class RunLayout(object):
         return sample_block
 
     def apply_method_rules(self, sample_block):
-        number_of_methods = self.run.number_of_methods or 1
+        number_of_methods = self.number_of_methods or 1
         if number_of_methods <= 1:
             return sample_block
 
         for sample in sample_block:
             sample.method_number = 1
-            sample.save()
 
         extended_sample_block = []
-        if self.run.is_method_type_individual_vial():
+        if self.order_of_methods == 2: # individual vial
             extended_sample_block = sample_block[:]
             for method_number in range(2, number_of_methods+1):
                 for sample in sample_block:
-                    extended_sample_block.append(RunSample.create_copy(sample, method_number))
+                    extended_sample_block.append(self.copy_item(sample, method_number))
         else:
             for sample in sample_block:
                 extended_sample_block.append(sample)
                 for method_number in range(2, number_of_methods+1):
-                    extended_sample_block.append(RunSample.create_copy(sample, method_number))
+                    extended_sample_block.append(self.copy_item(sample, method_number))
 
         return extended_sample_block
 
+    def copy_item(self, source, method_number):
+        return self.new_item(component_id=source.component_id,
+                             sample_id=source.sample_id, method_number=method_number)
+
+    def is_blank(self, item):
+        # RunSample.is_blank() looks up the component group, so only do it once per component
+        if item.component_id not in self._blank_components:
+            self._blank_components[item.component_id] = item.is_blank()
+        return self._blank_components[item.component_id]
+
     def add_sweeps(self, items):
         items_with_sweeps = []
         for item in items:
             items_with_sweeps.append(item)
-            if not item.is_blank():
-                items_with_sweeps.append(RunSample.create_sweep(self.run))
+            if not self.is_blank(item):
+                items_with_sweeps.append(self.new_item(component_id=RunSample.SWEEP_ID))
         return items_with_sweeps
 
+class PreviewLayout(WorklistLayout):
+    """
+    Lays out a number of placeholder samples, for showing what a rule
+    generator would do to a run.
+    """
+    def __init__(self, rule_generator, number_of_methods=None, order_of_methods=None):
+        super(PreviewLayout, self).__init__(rule_generator, number_of_methods, order_of_methods)
+        self.components = dict((c.id, c) for c in Component.objects.select_related("component_group"))
+
+    def preview(self, sample_count):
+        "Returns the worklist as a list of dicts."
+        samples = []
+        for i in range(sample_count):
+            sample = self.new_item(component_id=0)
+            sample.sample_number = i+1
+            samples.append(sample)
+
+        return [self.item_dict(item) for item in self.layout(samples)]
+
+    def item_dict(self, item):
+        component = self.components.get(item.component_id)
+        return {
+            "sequence": item.sequence,
+            "component_id": item.component_id,
+            "sample_type": component.sample_type if component else "Sample",
+            "sample_code": component.sample_code if component else "Smp",
+            "method_number": item.method_number,
+            "sample_number": getattr(item, "sample_number", None),
+        }
+
+    def copy_item(self, source, method_number):
+        item = super(PreviewLayout, self).copy_item(source, method_number)
+        item.sample_number = getattr(source, "sample_number", None)
+        return item
+
+    def is_blank(self, item):
+        component = self.components.get(item.component_id)
+        return component is not None and component.component_group.name == 'Blank'
+
+class RunLayout(WorklistLayout):
+    """
+    Lays out the run's samples according to its rule generator, and
+    replaces the run's other RunSamples with the result.
+    """
+    def __init__(self, run):
+        super(RunLayout, self).__init__(run.rule_generator, run.number_of_methods,
+                                        run.order_of_methods, run=run)
+
+    def perform_layout(self):
+        with transaction.atomic():
+            self.delete_nonsample_run_samples()
+            samples = list(self.run.runsample_set.filter(component__id=0).order_by('sequence'))
+            self.save_items(self.layout(samples))
+
+    def delete_nonsample_run_samples(self):
+        # Deletes all the RunSamples that aren't Samples (ie. Standards, Blanks etc.)
+        RunSample.objects.filter(run=self.run, component__id__gt=0).delete()
+        # TODO another reason the generator should generate a clean worklist in a different DB table
+        # We have to ensure that only method 1 Samples are kept and method_number is resetted to None
+        RunSample.objects.filter(run=self.run, method_number__gt=1).delete()
+        RunSample.objects.filter(run=self.run, method_number=1).update(method_number=None)
+
     def save_items(self, items):
-        for seq, item in enumerate(items):
-            item.sequence = seq+1
-            item.save()
+        """
+        Inserts the new items with a bulk insert and renumbers the
+        existing samples with a few UPDATE statements.
+        """
+        update_runsamples([item for item in items if item.pk is not None],
+                          "sequence", "method_number")
+        RunSample.objects.bulk_create([item for item in items if item.pk is None])
+
+        # bulk_create() doesn't call save(), so the run has to be recounted here
+        sample_counts_changed(self.run)
+
+# keeps the number of query parameters within database limits
+UPDATE_BATCH_SIZE = 100
+
+def update_runsamples(runsamples, *attrs):
+    """
+    Saves the given attributes of many RunSamples, with one UPDATE per
+    batch of rows rather than one per row. Doesn't recount the run.
+    """
+    for start in range(0, len(runsamples), UPDATE_BATCH_SIZE):
+        batch = runsamples[start:start + UPDATE_BATCH_SIZE]
+        values = {}
+        for attr in attrs:
+            if all(getattr(rs, attr) is None for rs in batch):
+                # PostgreSQL types a CASE of only NULLs as text, and
+                # Django 1.8 has no Cast, so set the column directly.
+                values[attr] = None
+            else:
+                values[attr] = Case(*[When(id=rs.pk, then=Value(getattr(rs, attr))) for rs in batch],
+                                    output_field=RunSample._meta.get_field(attr))
+        RunSample.objects.filter(id__in=[rs.pk for rs in batch]).update(
+            last_modified=datetime.now(), **values)
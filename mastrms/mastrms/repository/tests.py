@@ -4,14 +4,30 @@ This file contains unit tests for the repository application.
 """
 from django.contrib.auth import get_user_model
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import Http404
 from django.utils import unittest
 from io import StringIO, BytesIO
 from decimal import Decimal
-from mastrms.repository.views import CSVUploadViewCaptureCSV, CSVUploadViewFile
-from mastrms.repository.models import Project, Experiment, Sample, InstrumentMethod, RunSample
+from mastrms.repository.views import CSVUploadViewCaptureCSV, CSVUploadViewFile, regenerate_sample_classes, clone_experiment, clone_run
+from mastrms.repository.views import query_records, recordsSamplesForExperiment, SAMPLE_SORT_FIELDS, SAMPLE_FILTER_FIELDS, recordsExperimentsForProject, recordsSamples, batch_create_sample_logs, recordsSampleClasses, recordsClientFiles
+from mastrms.repository.views import uploadFileStart, uploadFileStatus, uploadFileChunk, uploadFileCommit
+from mastrms.repository.views import preview_rule_generator, PREVIEW_MAX_SAMPLES, PREVIEW_MAX_METHODS
+from mastrms.repository.models import Project, Experiment, Sample, SampleClass, InstrumentMethod, Run, RunSample, RUN_STATES, deferred_sample_counts
+from mastrms.repository.models import Component, ComponentGroup, RuleGenerator, RuleGeneratorStartBlock, RuleGeneratorSampleBlock, RuleGeneratorEndBlock
+from mastrms.repository.models import BiologicalSource, OrganismType, Organ, Treatment, SampleTimeline, UserExperiment, UserInvolvementType, SampleLog, ClientFile
+from mastrms.repository.runbuilder import RunBuilder, PreviewLayout
+from mastrms.users.models import User
 from mastrms.mdatasync_server.models import NodeClient
+from mastrms.testutils import WithRun
+from mastrms.app.utils.file_utils import ensure_repo_filestore_dir_with_owner, is_ensured_repo_dir, forget_ensured_repo_dirs, list_dir, forget_dir_listings
+from mastrms.app.utils.data_utils import zipstream_dir, stream_package, threaded_iter
+from mastrms.app.utils.download_utils import file_response, sendfile_response
 import json, logging
+import os, stat, grp, shutil, tempfile, threading, time, zipfile, tarfile
 logger = logging.getLogger(__name__)
 
 class SampleCsvUploadTest(TestCase):
@@ -441,6 +457,34 @@ Sample Label
         self.assertEqual(result["num_created"], 1)
         self.assertEqual(result["num_updated"], 2)
 
+    def test_bulk(self):
+        """
+        Large files are saved in batches. The sample ids are looked up
+        once per batch, and only when the batch has ids.
+        """
+        samples = [Sample.objects.create(experiment=self.experiment, label="old", weight=Decimal("5"))
+                   for i in range(3)]
+        other = Sample.objects.create(experiment=Experiment.objects.create(
+            title="Other", job_number="002", project=self.experiment.project))
+
+        lines = ["id,label,weight,comment"]
+        lines += ["%d,updated %d,,a comment" % (s.id, i) for i, s in enumerate(samples)]
+        lines += ["%d,not mine,1,a comment" % other.id]
+        lines += [",new %d,2,a comment" % i for i in range(1200)]
+
+        with CaptureQueriesContext(connection) as queries:
+            result = self.upload_csv("\n".join(lines) + "\n")
+        count = lambda sql: sum(sql in q["sql"] for q in queries.captured_queries)
+        self.assertEqual(count('SELECT "repository_sample"."id" FROM'), 1)
+        self.assertEqual(count('UPDATE "repository_sample"'), 1)
+
+        self.assertTrue(result["success"])
+        self.assertEqual((result["num_created"], result["num_updated"]), (1201, 3))
+        self.assertEqual(Sample.objects.filter(experiment=self.experiment).count(), 1204)
+        self.assertEqual([(s.label, s.weight) for s in Sample.objects.filter(id__in=[s.id for s in samples]).order_by("id")],
+                         [("updated %d" % i, Decimal("5")) for i in range(3)])
+        self.assertEqual(Sample.objects.get(id=other.id).label, "")
+
 class UploadRunCaptureCSVTest(TestCase):
     """
     Unit tests for parsing of uploaded samples CSV. The target
@@ -458,9 +502,10 @@ class UploadRunCaptureCSVTest(TestCase):
             self.machine,
             self.method,
             'A Test Run',
-            get_user_model().objects.all()[0])
+            self.user)
 
     def setUp(self):
+        self.user = User.objects.create(email="capture@example.com")
         project = Project.objects.create(title="Test Project",
                                          description="Test",
                                          client=None)
@@ -480,7 +525,7 @@ class UploadRunCaptureCSVTest(TestCase):
             method_path = "/test",
             method_name = "rusty python",
             version = "2.7.3",
-            creator = get_user_model().objects.all()[0]
+            creator = self.user
             )
 
     def test_upload_runcapture(self):
@@ -538,3 +583,1038 @@ class UploadRunCaptureCSVTest(TestCase):
         self.assertEqual(run_samples[2].filename, "budgie.jpg")
 
         self.assertEqual(result['num_created'], 3)
+
+    def test_upload_counts(self):
+        """
+        The samples are saved together and the run is counted once.
+        """
+        text = "filename\n" + "".join("sample%d.d\n" % i for i in range(100))
+        with self.assertNumQueries(6):
+            result = self.upload_csv(text)
+
+        self.assertTrue(result['success'])
+        self.assertEqual(result['num_created'], 100)
+        run = Run.objects.get()
+        self.assertEqual((run.sample_count, run.incomplete_sample_count), (100, 100))
+        self.assertEqual(run.runsample_set.count(), 100)
+
+    def test_upload_empty(self):
+        """
+        A file with no rows is refused rather than making an empty
+        run, which would count as complete.
+        """
+        for text in ["", "filename\n\n\n"]:
+            result = self.upload_csv(text)
+            self.assertFalse(result['success'])
+            self.assertEqual(result['num_created'], 0)
+        self.assertEqual(Run.objects.count(), 0)
+
+    def test_upload_invalid(self):
+        """
+        No run is created from a file with errors.
+        """
+        text = "id,filename\n1,cat.jpg\nx,dog.jpg\n"
+        result = self.upload_csv(text)
+
+        self.assertFalse(result['success'])
+        self.assertEqual(result['invalid_lines'], [3])
+        self.assertEqual(Run.objects.count(), 0)
+        self.assertEqual(RunSample.objects.count(), 0)
+
+class EnsureRepoDirTest(TestCase):
+    """
+    Tests that directories which have already been set up by
+    `ensure_repo_filestore_dir_with_owner` aren't set up again.
+    """
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix="testrepo-")
+        self.addCleanup(shutil.rmtree, self.repo)
+        self.group = grp.getgrgid(os.getgid()).gr_name
+        forget_ensured_repo_dirs()
+        self.addCleanup(forget_ensured_repo_dirs)
+
+    def ensure(self, relpath):
+        with self.settings(REPO_FILES_ROOT=self.repo):
+            ensure_repo_filestore_dir_with_owner(relpath, groupname=self.group)
+        return os.path.join(self.repo, relpath)
+
+    def test_ensure_creates_dir(self):
+        path = self.ensure("experiments/1")
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0770)
+        self.assertTrue(is_ensured_repo_dir(path))
+
+    def test_ensure_cached(self):
+        path = self.ensure("experiments/1")
+        os.chmod(path, 0755)
+
+        # permissions aren't checked again while the dir is remembered
+        self.ensure("experiments/1")
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0755)
+
+        forget_ensured_repo_dirs()
+        self.ensure("experiments/1")
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0770)
+
+    def test_ensure_removed_dir(self):
+        path = self.ensure("experiments/1")
+        os.rmdir(path)
+
+        self.ensure("experiments/1")
+        self.assertTrue(os.path.isdir(path))
+
+    def test_ensure_expired(self):
+        path = self.ensure("experiments/1")
+        with self.settings(REPO_DIR_CACHE_TTL=-1):
+            self.assertFalse(is_ensured_repo_dir(path))
+
+class ListDirTest(TestCase):
+    """
+    Tests the directory listings given by `list_dir`, and their caching.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="testlist-")
+        self.addCleanup(shutil.rmtree, self.dir)
+        forget_dir_listings()
+        self.addCleanup(forget_dir_listings)
+        os.mkdir(os.path.join(self.dir, "b.d"))
+        open(os.path.join(self.dir, "a.txt"), "w").close()
+
+    def set_mtime(self, mtime):
+        os.utime(self.dir, (mtime, mtime))
+
+    def test_list(self):
+        self.assertEqual(list_dir(self.dir), [("a.txt", False), ("b.d", True)])
+        self.assertRaises(OSError, list_dir, os.path.join(self.dir, "missing"))
+
+    def test_cached(self):
+        mtime = int(time.time()) - 60
+        self.set_mtime(mtime)
+        listing = list_dir(self.dir)
+
+        # an unchanged directory isn't read again
+        os.rename(os.path.join(self.dir, "a.txt"), os.path.join(self.dir, "c.txt"))
+        self.set_mtime(mtime)
+        self.assertEqual(list_dir(self.dir), listing)
+
+        self.set_mtime(mtime + 30)
+        self.assertEqual(list_dir(self.dir), [("b.d", True), ("c.txt", False)])
+
+    def test_recent_not_cached(self):
+        list_dir(self.dir)
+        os.rename(os.path.join(self.dir, "a.txt"), os.path.join(self.dir, "c.txt"))
+        self.assertEqual(list_dir(self.dir), [("b.d", True), ("c.txt", False)])
+
+class ZipStreamDirTest(TestCase):
+    """
+    Tests the directory archives streamed by `zipstream_dir`.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="testzip-")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.data = os.path.join(self.dir, "sample.d")
+        os.makedirs(os.path.join(self.data, "empty"))
+        with open(os.path.join(self.data, "acq.txt"), "w") as f:
+            f.write("data " * 100)
+        with open(os.path.join(self.data, "raw.gz"), "w") as f:
+            f.write("compressed")
+
+    def unzip(self, *args, **kwargs):
+        content = b"".join(zipstream_dir(self.data, *args, **kwargs))
+        return zipfile.ZipFile(BytesIO(content))
+
+    def test_zip(self):
+        archive = self.unzip()
+        self.assertEqual(sorted(archive.namelist()),
+                         ["sample.d/acq.txt", "sample.d/empty/", "sample.d/raw.gz"])
+        self.assertEqual(archive.read("sample.d/acq.txt"), "data " * 100)
+        self.assertEqual(archive.getinfo("sample.d/acq.txt").compress_type, zipfile.ZIP_DEFLATED)
+        # compressed files aren't deflated again
+        self.assertEqual(archive.getinfo("sample.d/raw.gz").compress_type, zipfile.ZIP_STORED)
+
+    def test_store(self):
+        archive = self.unzip(includeDirInZip=False, compress=False)
+        self.assertEqual(sorted(archive.namelist()), ["acq.txt", "empty/", "raw.gz"])
+        self.assertEqual(archive.getinfo("acq.txt").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.read("acq.txt"), "data " * 100)
+
+class StreamPackageTest(TestCase):
+    """
+    Tests the packages of files streamed by `stream_package`.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="testpackage-")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.big = os.urandom(200 * 1024 + 3)
+        self.long_name = "x" * 120 + ".txt"
+        os.makedirs(os.path.join(self.dir, "sample.d", "empty"))
+        with open(os.path.join(self.dir, "sample.d", "big.bin"), "wb") as f:
+            f.write(self.big)
+        with open(os.path.join(self.dir, "sample.d", self.long_name), "w") as f:
+            f.write("long")
+        with open(os.path.join(self.dir, "notes.txt"), "w") as f:
+            f.write("notes")
+        self.files = [(os.path.join(self.dir, "sample.d"), "Raw Data/sample.d"),
+                      (os.path.join(self.dir, "notes.txt"), "notes.txt")]
+
+    def untar(self, package_name, **kwargs):
+        content = b"".join(stream_package(self.files, package_name, **kwargs))
+        return tarfile.open(fileobj=BytesIO(content), mode="r:*")
+
+    def check_tar(self, tar):
+        self.assertEqual(tar.getnames(), [
+            "Raw Data/sample.d", "Raw Data/sample.d/empty", "Raw Data/sample.d/big.bin",
+            "Raw Data/sample.d/" + self.long_name, "notes.txt"])
+        self.assertTrue(tar.getmember("Raw Data/sample.d/empty").isdir())
+        self.assertEqual(tar.extractfile("Raw Data/sample.d/big.bin").read(), self.big)
+        self.assertEqual(tar.extractfile("Raw Data/sample.d/" + self.long_name).read(), "long")
+        self.assertEqual(tar.extractfile("notes.txt").read(), "notes")
+
+    def test_tar(self):
+        for package_name in ["files.tar", "files.tgz", "files.tbz2"]:
+            self.check_tar(self.untar(package_name))
+
+    def test_compressed(self):
+        content = b"".join(stream_package(self.files, "files.tgz"))
+        self.assertEqual(content[:2], b"\x1f\x8b")
+        content = b"".join(stream_package(self.files, "files.tbz2"))
+        self.assertEqual(content[:3], b"BZh")
+
+    def test_threaded(self):
+        self.check_tar(self.untar("files.tgz", threaded=True))
+
+    def test_zip(self):
+        content = b"".join(stream_package(self.files, "files.zip", compress=False))
+        archive = zipfile.ZipFile(BytesIO(content))
+        self.assertEqual(archive.namelist(), [
+            "Raw Data/sample.d/empty/", "Raw Data/sample.d/big.bin",
+            "Raw Data/sample.d/" + self.long_name, "notes.txt"])
+        self.assertEqual(archive.read("Raw Data/sample.d/big.bin"), self.big)
+        self.assertEqual(archive.getinfo("notes.txt").compress_type, zipfile.ZIP_STORED)
+
+    def test_threaded_iter(self):
+        def fail():
+            yield "a"
+            raise ValueError("broken")
+        items = threaded_iter(fail())
+        self.assertEqual(next(items), "a")
+        self.assertRaises(ValueError, next, items)
+
+    def test_threaded_iter_close(self):
+        """
+        Closing early, or never starting, doesn't leave a worker
+        thread blocked on the queue or the source open.
+        """
+        closed = []
+        def source():
+            try:
+                for i in xrange(1000):
+                    yield i
+            finally:
+                closed.append(True)
+        workers = lambda: [t for t in threading.enumerate() if t.name == "threaded_iter"]
+
+        items = threaded_iter(source(), max_chunks=2)
+        self.assertEqual(workers(), [])
+        self.assertEqual(next(items), 0)
+        worker, = workers()
+        self.assertTrue(worker.daemon)
+
+        items.close()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(closed, [True])
+
+        # an iterator which is never used starts no thread
+        threaded_iter(source()).close()
+        self.assertEqual(workers(), [])
+
+class FileResponseTest(TestCase):
+    """
+    Tests conditional and Range requests for downloads by `file_response`.
+    """
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(prefix="testdownload-")
+        self.addCleanup(os.remove, self.filename)
+        self.data = "".join(chr(i % 256) for i in range(100000))
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.data)
+
+    def download(self, **headers):
+        request = RequestFactory().get("/", **headers)
+        return file_response(request, self.filename, "data.bin")
+
+    def test_whole(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        self.assertEqual(response["Content-Length"], "100000")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Content-Disposition"], 'attachment;  filename="data.bin"')
+
+    def test_range(self):
+        response = self.download(HTTP_RANGE="bytes=90000-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 90000-99999/100000")
+        self.assertEqual(b"".join(response.streaming_content), self.data[90000:])
+
+        response = self.download(HTTP_RANGE="bytes=10-19")
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        response = self.download(HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), self.data[-5:])
+
+        self.assertEqual(self.download(HTTP_RANGE="bytes=200000-").status_code, 416)
+        # multiple ranges aren't supported, so the whole file is sent
+        self.assertEqual(self.download(HTTP_RANGE="bytes=0-1,5-6").status_code, 200)
+
+    def test_if_range(self):
+        etag = self.download()["ETag"]
+        self.assertEqual(self.download(HTTP_RANGE="bytes=10-", HTTP_IF_RANGE=etag).status_code, 206)
+        # the file has changed since, so it's all sent again
+        self.assertEqual(self.download(HTTP_RANGE="bytes=10-", HTTP_IF_RANGE='"old"').status_code, 200)
+
+    def test_not_modified(self):
+        response = self.download()
+        self.assertEqual(self.download(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertEqual(self.download(HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304)
+
+    def test_sendfile(self):
+        with self.settings(DOWNLOAD_SENDFILE="x-sendfile"):
+            self.assertEqual(self.download()["X-Sendfile"], self.filename)
+        with self.settings(DOWNLOAD_SENDFILE="x-accel-redirect", DOWNLOAD_ACCEL_REDIRECT_PREFIX="/protected/"):
+            response = self.download()
+            self.assertEqual(response["X-Accel-Redirect"], "/protected" + self.filename)
+            self.assertEqual(response.content, "")
+
+    def test_sendfile_unicode(self):
+        """
+        Paths which aren't ASCII are sent to the web server as UTF-8.
+        """
+        filename = u"/data/r\xe9sum\xe9.txt"
+        with self.settings(DOWNLOAD_SENDFILE="x-sendfile"):
+            response = sendfile_response(filename, "text/plain")
+            self.assertEqual(response["X-Sendfile"], filename.encode("utf-8"))
+        with self.settings(DOWNLOAD_SENDFILE="x-accel-redirect", DOWNLOAD_ACCEL_REDIRECT_PREFIX=u"/protected/"):
+            response = sendfile_response(filename, "text/plain")
+            self.assertEqual(response["X-Accel-Redirect"], "/protected/data/r%C3%A9sum%C3%A9.txt")
+
+class SampleCountsTest(WithRun, TestCase):
+    """
+    Tests that the sample counts of runs are kept up to date, whether
+    or not updates are deferred by `deferred_sample_counts`.
+    """
+
+    def setUp(self):
+        self.setup_run()
+
+    def assertCounts(self, run, complete, incomplete):
+        run = Run.objects.get(id=run.id)
+        self.assertEqual(run.sample_count, complete + incomplete)
+        self.assertEqual(run.complete_sample_count, complete)
+        self.assertEqual(run.incomplete_sample_count, incomplete)
+        return run
+
+    def test_single_saves(self):
+        """
+        Saving and deleting a runsample updates its run immediately.
+        """
+        rs = RunSample.objects.create(run=self.run, component_id=RunSample.SWEEP_ID)
+        RunSample.objects.create(run=self.run, component_id=RunSample.SWEEP_ID)
+        self.assertCounts(self.run, 0, 2)
+
+        rs.complete = True
+        rs.save()
+        self.assertCounts(self.run, 1, 1)
+
+        RunSample.objects.filter(run=self.run, complete=False)[0].delete()
+        run = self.assertCounts(self.run, 1, 0)
+        self.assertEqual(run.state, RUN_STATES.COMPLETE[0])
+
+    def test_deferred(self):
+        """
+        Inside the block, runs aren't touched. They are updated once
+        at the end.
+        """
+        with deferred_sample_counts():
+            for i in range(5):
+                RunSample.objects.create(run=self.run, component_id=RunSample.SWEEP_ID)
+            with deferred_sample_counts():
+                RunSample.objects.create(run=self.run, component_id=RunSample.SWEEP_ID, complete=True)
+            self.assertCounts(self.run, 0, 0)
+        run = self.assertCounts(self.run, 1, 5)
+        self.assertEqual(run.state, RUN_STATES.NEW[0])
+
+        # one aggregate query and one update per run
+        RunSample.objects.filter(run=self.run).update(complete=True)
+        with self.assertNumQueries(2):
+            Run.update_sample_counts_for([self.run])
+        run = self.assertCounts(self.run, 6, 0)
+        self.assertEqual(run.state, RUN_STATES.COMPLETE[0])
+
+    def test_deferred_error(self):
+        """
+        If the block fails, its changes are rolled back along with
+        the counts.
+        """
+        with self.assertRaises(ValueError):
+            with deferred_sample_counts():
+                RunSample.objects.create(run=self.run, component_id=RunSample.SWEEP_ID)
+                raise ValueError()
+        self.assertEqual(RunSample.objects.filter(run=self.run).count(), 0)
+        self.assertCounts(self.run, 0, 0)
+
+class RunLayoutTest(WithRun, TestCase):
+    """
+    Tests the worklist layout done by `RunBuilder.layout`.
+    """
+
+    def setUp(self):
+        experiment = self.setup_experiment()
+        # samples in runs have component 0
+        Component.objects.create(id=0, sample_type="Sample", sample_code="Smp",
+                                 component_group=ComponentGroup.objects.get(name="Sample"),
+                                 filename_prefix="sample")
+        self.std = Component.objects.get(sample_code="Std")
+        self.pbqc = Component.objects.get(sample_code="pbqc")
+        self.rb = Component.objects.get(sample_code="RB")
+
+        rg = RuleGenerator.objects.create(name="Test Rules", created_by=self.user)
+        RuleGeneratorStartBlock.objects.create(rule_generator=rg, index=0, count=1, component=self.std)
+        RuleGeneratorSampleBlock.objects.create(rule_generator=rg, index=0, sample_count=2,
+                                                count=1, component=self.pbqc, order=2)
+        RuleGeneratorEndBlock.objects.create(rule_generator=rg, index=0, count=1, component=self.rb)
+
+        self.setup_run(rule_generator=rg, number_of_methods=2, order_of_methods=1)
+        sclass = SampleClass.objects.create(class_id="CLS", experiment=experiment)
+        for i in range(4):
+            sample = Sample.objects.create(sample_class=sclass, experiment=experiment,
+                                           label="sample%d" % i)
+            RunSample.objects.create(run=self.run, sample=sample, sequence=i)
+
+    def test_layout(self):
+        """
+        Standards, QCs, blanks, sweeps and extra methods are all laid
+        out, and the run is recounted.
+        """
+        samples = list(RunSample.objects.filter(run=self.run).order_by("sequence"))
+        RunBuilder(self.run).layout()
+
+        items = list(RunSample.objects.filter(run=self.run).order_by("sequence"))
+        self.assertEqual([rs.sequence for rs in items], range(1, 28))
+
+        sweep = RunSample.SWEEP_ID
+        s = lambda n, m: (0, samples[n].sample_id, m)
+        expected = [(self.std.id, None, None), (sweep, None, None)]
+        for pair in [(0, 1), (2, 3)]:
+            for n in pair:
+                expected += [s(n, 1), (sweep, None, None), s(n, 2), (sweep, None, None)]
+            expected += [(self.pbqc.id, None, 1), (sweep, None, None),
+                         (self.pbqc.id, None, 2), (sweep, None, None)]
+        expected += [(self.rb.id, None, None)]
+        self.assertEqual([(rs.component_id, rs.sample_id, rs.method_number) for rs in items], expected)
+
+        # the original samples are kept
+        self.assertEqual(set(rs.id for rs in items if rs.method_number == 1 and rs.sample_id),
+                         set(rs.id for rs in samples))
+
+        run = Run.objects.get(id=self.run.id)
+        self.assertEqual(run.sample_count, 27)
+        self.assertEqual(run.incomplete_sample_count, 27)
+
+    def test_relayout(self):
+        """
+        Laying out again replaces everything but the samples.
+        """
+        RunBuilder(self.run).layout()
+        RunBuilder(self.run).layout()
+        self.assertEqual(RunSample.objects.filter(run=self.run).count(), 27)
+        self.assertEqual(Run.objects.get(id=self.run.id).sample_count, 27)
+
+    def test_relayout_single_method(self):
+        """
+        With one method every method_number is NULL, which is set
+        directly rather than with a CASE that PostgreSQL can't type.
+        """
+        Run.objects.filter(id=self.run.id).update(number_of_methods=1)
+        self.run = Run.objects.get(id=self.run.id)
+        RunBuilder(self.run).layout()
+        with CaptureQueriesContext(connection) as queries:
+            RunBuilder(self.run).layout()
+
+        updates = [q["sql"] for q in queries.captured_queries if 'UPDATE "repository_run_samples"' in q["sql"]]
+        self.assertTrue(any('"method_number" = NULL' in sql for sql in updates))
+        self.assertFalse(any("THEN NULL" in sql for sql in updates))
+
+        items = RunSample.objects.filter(run=self.run)
+        self.assertEqual(set(rs.method_number for rs in items), set([None]))
+        self.assertEqual(items.filter(component__id=0).count(), 4)
+        self.assertEqual(Run.objects.get(id=self.run.id).sample_count, items.count())
+
+    def test_generate(self):
+        """
+        Every item gets a filename, and the run moves to in progress.
+        """
+        self.run.machine = NodeClient.objects.create(organisation_name="org",
+                                                     site_name="site",
+                                                     station_name="station")
+        self.run.save()
+        RunBuilder(self.run).generate()
+
+        items = RunSample.objects.filter(run=self.run).order_by("sequence")
+        filenames = [rs.filename for rs in items]
+        self.assertEqual(len(set(filenames)), 27)
+        self.assertEqual(filenames[0], "standard_%d-%d.d" % (self.run.id, items[0].id))
+        self.assertEqual(filenames[2], "CLS-1-sample0_%d-%d_m1.d" % (self.run.id, items[2].sample_id))
+        self.assertEqual(Run.objects.get(id=self.run.id).state, RUN_STATES.IN_PROGRESS[0])
+
+    def test_preview(self):
+        """
+        The preview matches what laying out the run produces, and
+        doesn't create anything.
+        """
+        preview = PreviewLayout(self.run.rule_generator, 2, 1).preview(4)
+        self.assertEqual(RunSample.objects.count(), 4)
+
+        RunBuilder(self.run).layout()
+        items = RunSample.objects.filter(run=self.run).order_by("sequence")
+        self.assertEqual([(p["sequence"], p["component_id"], p["method_number"]) for p in preview],
+                         [(rs.sequence, rs.component_id, rs.method_number) for rs in items])
+        self.assertEqual([p["sample_number"] for p in preview if p["sample_number"]],
+                         [1, 1, 2, 2, 3, 3, 4, 4])
+        self.assertEqual(preview[0]["sample_code"], "Std")
+
+    def test_preview_limits(self):
+        """
+        Previews of too many samples or methods are refused.
+        """
+        admin = User.objects.create(email="admin@example.com")
+        admin.IsAdmin = True
+        def preview(**params):
+            params.setdefault("sample_count", 4)
+            request = RequestFactory().get("/", dict(params, id=self.run.rule_generator.id))
+            request.user = User.objects.get(id=admin.id)
+            return preview_rule_generator(request)
+
+        response = preview(number_of_methods=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["total"], 27)
+
+        for params in [{"number_of_methods": PREVIEW_MAX_METHODS + 1}, {"number_of_methods": -1},
+                       {"sample_count": PREVIEW_MAX_SAMPLES + 1}, {"order_of_methods": 3},
+                       {"number_of_methods": "many"}]:
+            response = preview(**params)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(json.loads(response.content)["success"])
+
+class RunSamplesTest(WithRun, TestCase):
+    """
+    Tests adding, removing and ordering the samples of a run.
+    """
+
+    def setUp(self):
+        experiment = self.setup_experiment()
+        self.setup_run()
+        sclass = SampleClass.objects.create(class_id="CLS", experiment=experiment)
+        self.samples = [Sample.objects.create(sample_class=sclass, experiment=experiment,
+                                              label="sample%d" % i)
+                        for i in range(5)]
+
+    def sequences(self):
+        return list(RunSample.objects.filter(run=self.run).order_by("id").values_list("sequence", flat=True))
+
+    def test_resequence(self):
+        """
+        Runsamples are numbered from 1 in the order they were created.
+        """
+        for sample, sequence in zip(self.samples, [7, 3, 3, 0, 9]):
+            RunSample.objects.create(run=self.run, sample=sample, sequence=sequence)
+        self.run.resequence_samples()
+        self.assertEqual(self.sequences(), [1, 2, 3, 4, 5])
+
+    def test_add_samples(self):
+        """
+        Samples are added in the given order, and samples already in
+        the run aren't added again.
+        """
+        self.run.add_samples([self.samples[3], self.samples[1]])
+        self.run.add_samples([self.samples[1], self.samples[4], self.samples[0], self.samples[4]])
+
+        runsamples = RunSample.objects.filter(run=self.run).order_by("sequence")
+        self.assertEqual([rs.sample for rs in runsamples],
+                         [self.samples[i] for i in (3, 1, 4, 0)])
+        self.assertEqual(self.sequences(), [1, 2, 3, 4])
+        self.assertEqual(Run.objects.get(id=self.run.id).sample_count, 4)
+
+    def test_remove_samples(self):
+        """
+        Removed samples leave no gaps in the sequence.
+        """
+        self.run.add_samples(self.samples)
+        self.run.remove_samples(Sample.objects.filter(id__in=[self.samples[0].id, self.samples[2].id]))
+
+        runsamples = RunSample.objects.filter(run=self.run).order_by("sequence")
+        self.assertEqual([rs.sample for rs in runsamples],
+                         [self.samples[i] for i in (1, 3, 4)])
+        self.assertEqual(self.sequences(), [1, 2, 3])
+        self.assertEqual(Run.objects.get(id=self.run.id).sample_count, 3)
+
+class RegenerateSampleClassesTest(TestCase):
+    """
+    Tests creation of sample classes for each combination of an
+    experiment's components by `regenerate_sample_classes`.
+    """
+
+    def setUp(self):
+        project = Project.objects.create(title="Test Project", client=None)
+        self.experiment = Experiment.objects.create(title="Test Experiment",
+                                                    job_number="001",
+                                                    project=project)
+        BiologicalSource.objects.create(experiment=self.experiment, abbreviation="B",
+                                        type=OrganismType.objects.all()[0])
+        for abbrev in ["O1", "O2"]:
+            Organ.objects.create(experiment=self.experiment, abbreviation=abbrev)
+        for abbrev in ["T1", "T2", "T3"]:
+            Treatment.objects.create(experiment=self.experiment, abbreviation=abbrev)
+
+    def class_ids(self):
+        return sorted(SampleClass.objects.filter(experiment=self.experiment).values_list("class_id", flat=True))
+
+    def test_combinations(self):
+        """
+        A class is made for each combination, and named after it.
+        """
+        regenerate_sample_classes(self.experiment.id)
+        self.assertEqual(self.class_ids(), ["BO1T1", "BO1T2", "BO1T3", "BO2T1", "BO2T2", "BO2T3"])
+
+        SampleTimeline.objects.create(experiment=self.experiment, abbreviation="D1")
+        regenerate_sample_classes(self.experiment.id)
+        self.assertEqual(self.class_ids(), ["BO1D1T1", "BO1D1T2", "BO1D1T3", "BO2D1T1", "BO2D1T2", "BO2D1T3"])
+
+    def test_existing_classes(self):
+        """
+        Matching classes are kept, and their samples renumbered.
+        Classes which no longer match are removed.
+        """
+        regenerate_sample_classes(self.experiment.id)
+        sc = SampleClass.objects.get(class_id="BO1T2")
+        samples = [Sample.objects.create(sample_class=sc, experiment=self.experiment,
+                                         sample_class_sequence=seq)
+                   for seq in [5, 5, 2]]
+        Treatment.objects.filter(abbreviation="T3").delete()
+
+        regenerate_sample_classes(self.experiment.id)
+        self.assertEqual(self.class_ids(), ["BO1T1", "BO1T2", "BO2T1", "BO2T2"])
+        self.assertEqual(SampleClass.objects.get(class_id="BO1T2").id, sc.id)
+        sequences = [Sample.objects.get(id=s.id).sample_class_sequence for s in samples]
+        self.assertEqual(sequences, [2, 3, 1])
+
+    def test_unnamed_classes(self):
+        """
+        Classes whose components have no abbreviations are named after their id.
+        """
+        Organ.objects.update(abbreviation="")
+        Treatment.objects.update(abbreviation="")
+        BiologicalSource.objects.update(abbreviation="")
+        regenerate_sample_classes(self.experiment.id)
+        classes = SampleClass.objects.filter(experiment=self.experiment)
+        self.assertEqual(len(classes), 6)
+        for sc in classes:
+            self.assertEqual(sc.class_id, "class_%d" % sc.id)
+
+    def test_records(self):
+        """
+        The classes are listed with their sample counts in one query.
+        """
+        regenerate_sample_classes(self.experiment.id)
+        sc = SampleClass.objects.get(class_id="BO1T2")
+        for i in range(3):
+            Sample.objects.create(sample_class=sc, experiment=self.experiment)
+
+        admin = User.objects.create(email="admin@example.com")
+        admin.IsAdmin = True
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(id=admin.id)
+
+        # the permission check and the classes
+        with self.assertNumQueries(2):
+            response = recordsSampleClasses(request, self.experiment.id)
+
+        rows = json.loads(response.content)["rows"]
+        self.assertEqual(len(rows), 6)
+        counts = dict((row["class_id"], row["count"]) for row in rows)
+        self.assertEqual(counts["BO1T2"], 3)
+        self.assertEqual(counts["BO1T1"], 0)
+
+class CloneTest(WithRun, TestCase):
+    """
+    Tests copying experiments with `clone_experiment` and runs with
+    `clone_run`.
+    """
+
+    def setUp(self):
+        self.setup_experiment()
+        UserExperiment.objects.create(user=self.user, experiment=self.experiment,
+                                      type=UserInvolvementType.objects.get(name="Principal Investigator"))
+        BiologicalSource.objects.create(experiment=self.experiment,
+                                        type=OrganismType.objects.all()[0])
+        for abbrev in ["O1", "O2"]:
+            Organ.objects.create(experiment=self.experiment, abbreviation=abbrev)
+        Treatment.objects.create(experiment=self.experiment, abbreviation="T1")
+        regenerate_sample_classes(self.experiment.id)
+        for i, sc in enumerate(SampleClass.objects.filter(experiment=self.experiment)):
+            for j in range(3):
+                Sample.objects.create(sample_class=sc, experiment=self.experiment,
+                                      label="sample%d-%d" % (i, j), sample_class_sequence=j+1)
+
+    def test_clone_experiment(self):
+        exp = clone_experiment(self.experiment)
+
+        self.assertEqual(exp.title, "Test Experiment (cloned)")
+        self.assertEqual(UserExperiment.objects.filter(experiment=exp, user=self.user).count(), 1)
+        self.assertEqual(Organ.objects.filter(experiment=exp).count(), 2)
+        samples = Sample.objects.filter(experiment=exp).order_by("label")
+        self.assertEqual([(s.label, s.sample_class.class_id, s.sample_class_sequence) for s in samples],
+                         [("sample%d-%d" % (i, j), "O%dT1" % (i+1), j+1)
+                          for i in range(2) for j in range(3)])
+
+    def test_clone_run(self):
+        run = self.setup_run(title="Run")
+        run.add_samples(Sample.objects.filter(experiment=self.experiment))
+
+        result = json.loads(clone_run(None, run.id).content)
+        self.assertTrue(result["success"])
+        new_run = Run.objects.get(id=result["data"]["id"])
+        self.assertEqual(new_run.title, "Run (cloned)")
+        self.assertEqual(new_run.sample_count, 6)
+        self.assertEqual(new_run.state, RUN_STATES.NEW[0])
+        self.assertEqual(list(new_run.runsample_set.order_by("sequence").values_list("sample_id", flat=True)),
+                         list(run.runsample_set.order_by("sequence").values_list("sample_id", flat=True)))
+
+class QueryRecordsTest(TestCase):
+    """
+    Tests the paging, sorting and filtering of records for ExtJS
+    stores by `query_records`.
+    """
+
+    def setUp(self):
+        project = Project.objects.create(title="Test Project", client=None)
+        self.experiment = Experiment.objects.create(title="Test Experiment",
+                                                    job_number="001",
+                                                    project=project)
+        for i in range(10):
+            Sample.objects.create(experiment=self.experiment, label="sample%d" % (9 - i))
+
+    def query(self, **args):
+        rows = Sample.objects.filter(experiment=self.experiment)
+        total, rows = query_records(rows, args, SAMPLE_SORT_FIELDS, ('id',), SAMPLE_FILTER_FIELDS)
+        return total, [row.label for row in rows]
+
+    def test_all(self):
+        """
+        Without a limit, every record is returned.
+        """
+        total, labels = self.query()
+        self.assertEqual(total, 10)
+        self.assertEqual(labels, ["sample%d" % i for i in range(9, -1, -1)])
+
+    def test_paging(self):
+        total, labels = self.query(start="4", limit="3", sort="label", dir="ASC")
+        self.assertEqual(total, 10)
+        self.assertEqual(labels, ["sample4", "sample5", "sample6"])
+
+        total, labels = self.query(start="8", limit="3", sort="label", dir="DESC")
+        self.assertEqual(labels, ["sample1", "sample0"])
+
+    def test_sorting(self):
+        """
+        Only whitelisted fields are sorted on.
+        """
+        total, labels = self.query(sort="label")
+        self.assertEqual(labels[0], "sample0")
+        total, labels = self.query(sort="experiment__project__client__password")
+        self.assertEqual(labels[0], "sample9")
+
+    def test_randomise(self):
+        """
+        Randomised samples are all sent at once, rather than paged
+        through separate random draws.
+        """
+        admin = User.objects.create(email="admin@example.com")
+        admin.IsAdmin = True
+        request = RequestFactory().get("/", {"experiment__id__exact": self.experiment.id,
+                                             "randomise": "true", "start": 2, "limit": 3})
+        request.user = User.objects.get(id=admin.id)
+        output = json.loads(recordsSamplesForExperiment(request).content)
+
+        self.assertEqual(output["results"], 10)
+        self.assertEqual(sorted(row["label"] for row in output["rows"]),
+                         ["sample%d" % i for i in range(10)])
+
+    def test_filtering(self):
+        total, labels = self.query(label="SAMPLE3")
+        self.assertEqual((total, labels), (1, ["sample3"]))
+        total, labels = self.query(sample_class="nonsense")
+        self.assertEqual((total, labels), (0, []))
+
+class ExperimentRecordsTest(TestCase):
+    """
+    Tests the experiment listing of `recordsExperimentsForProject`.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create(email="admin@example.com")
+        self.admin.IsAdmin = True
+        self.project = Project.objects.create(title="Test Project", client=self.admin)
+        client_type = UserInvolvementType.objects.get(name="Client")
+        pi_type = UserInvolvementType.objects.get(name="Principal Investigator")
+        for i in range(5):
+            exp = Experiment.objects.create(title="Experiment %d" % i,
+                                            job_number="00%d" % i,
+                                            project=self.project)
+            client = User.objects.create(email="client%d@example.com" % i)
+            UserExperiment.objects.create(user=client, experiment=exp, type=client_type)
+            if i % 2 == 0:
+                pi = User.objects.create(email="pi%d@example.com" % i)
+                UserExperiment.objects.create(user=pi, experiment=exp, type=pi_type)
+
+    def test_experiments(self):
+        """
+        The client and principal of every experiment are found with a
+        fixed number of queries.
+        """
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(id=self.admin.id)
+
+        # the permission check, the experiments and their involved users
+        with self.assertNumQueries(3):
+            response = recordsExperimentsForProject(request, self.project.id)
+
+        rows = json.loads(response.content)["rows"]
+        self.assertEqual([(row["client"], row["principal"]) for row in rows],
+                         [("client%d@example.com" % i, "pi%d@example.com" % i if i % 2 == 0 else "")
+                          for i in range(5)])
+
+
+class SampleLogTest(TestCase):
+    """
+    Tests that samples keep a reference to their latest log entry.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create(email="admin@example.com")
+        self.admin.IsAdmin = True
+        project = Project.objects.create(title="Test Project", client=self.admin)
+        self.experiment = Experiment.objects.create(title="Test Experiment", job_number="001", project=project)
+        self.samples = [Sample.objects.create(experiment=self.experiment, label="s%d" % i)
+                        for i in range(3)]
+
+    def test_latest_log(self):
+        sample = self.samples[0]
+        SampleLog.objects.create(sample=sample, type=0, description="in")
+        latest = SampleLog.objects.create(sample=sample, type=1, description="freezer")
+        self.assertEqual(Sample.objects.get(id=sample.id).last_log_id, latest.id)
+        self.assertEqual(Sample.objects.get(id=sample.id).last_status, "Stored: freezer")
+
+        latest.delete()
+        self.assertEqual(Sample.objects.get(id=sample.id).last_status, "Received: in")
+        self.assertEqual(Sample.objects.get(id=self.samples[1].id).last_status, "")
+
+    def test_queryset_delete(self):
+        """
+        Deleting logs through a queryset, as the admin does, also
+        falls back to the previous log.
+        """
+        sample = self.samples[0]
+        SampleLog.objects.create(sample=sample, type=0, description="in")
+        latest = SampleLog.objects.create(sample=sample, type=1, description="freezer")
+        SampleLog.objects.create(sample=self.samples[1], type=2, description="prep")
+
+        SampleLog.objects.filter(id=latest.id).delete()
+        self.assertEqual(Sample.objects.get(id=sample.id).last_status, "Received: in")
+        self.assertEqual(Sample.objects.get(id=self.samples[1].id).last_status, "Prepared: prep")
+
+        SampleLog.objects.filter(sample=sample).delete()
+        self.assertEqual(Sample.objects.get(id=sample.id).last_status, "")
+
+        # the logs go along with their sample
+        self.samples[1].delete()
+        self.assertEqual(SampleLog.objects.count(), 0)
+
+    def test_update_last_logs(self):
+        SampleLog.objects.bulk_create([SampleLog(sample=s, type=2, description="prep")
+                                       for s in self.samples[:2]])
+        Sample.update_last_logs([s.id for s in self.samples])
+        self.assertEqual([s.last_status for s in Sample.objects.order_by("id")],
+                         ["Prepared: prep", "Prepared: prep", ""])
+
+    def test_records_samples(self):
+        for sample in self.samples:
+            SampleLog.objects.create(sample=sample, type=3, description="run %d" % sample.id)
+
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(id=self.admin.id)
+
+        # the permission check and the samples with their logs
+        with self.assertNumQueries(2):
+            response = recordsSamples(request, self.experiment.id)
+
+        rows = json.loads(response.content)["rows"]
+        self.assertEqual([row["last_status"] for row in rows],
+                         ["Acquired: run %d" % s.id for s in self.samples])
+
+    def test_batch_create(self):
+        other = User.objects.create(email="other@example.com")
+        other.IsMastrStaff = True
+        UserExperiment.objects.create(user=other, experiment=self.experiment,
+                                      type=UserInvolvementType.objects.get(name="Involved User"))
+        project = Project.objects.create(title="Other Project", client=self.admin)
+        hidden = Sample.objects.create(experiment=Experiment.objects.create(
+            title="Hidden", job_number="002", project=project))
+
+        ids = [s.id for s in self.samples[:2]] + [hidden.id, 9999]
+        request = RequestFactory().post("/", {"type": "1", "description": "freezer",
+                                              "sample_ids": ",".join(map(str, ids))})
+        request.user = User.objects.get(id=other.id)
+        response = batch_create_sample_logs(request)
+
+        rows = json.loads(response.content)["rows"]
+        self.assertEqual([(row["id"], row["success"]) for row in rows],
+                         zip(ids, [True, True, False, False]))
+        self.assertEqual(rows[0]["last_status"], "Stored: freezer")
+        self.assertEqual(SampleLog.objects.filter(user=other).count(), 2)
+        self.assertEqual([s.last_status for s in Sample.objects.filter(id__in=ids).order_by("id")],
+                         ["Stored: freezer", "Stored: freezer", ""])
+
+    def test_batch_create_invalid(self):
+        request = RequestFactory().post("/", {"type": "9", "sample_ids": str(self.samples[0].id)})
+        request.user = User.objects.get(id=self.admin.id)
+        self.assertEqual(batch_create_sample_logs(request).status_code, 400)
+        self.assertFalse(SampleLog.objects.exists())
+
+
+class ClientFilesTest(TestCase):
+    """
+    Tests the tree of shared files given by `recordsClientFiles`.
+    """
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix="testrepo-")
+        self.addCleanup(shutil.rmtree, self.repo)
+        self.client_user = User.objects.create(email="client@example.com")
+        project = Project.objects.create(title="Test Project", client=self.client_user)
+        self.experiment = Experiment.objects.create(title="Test Experiment", job_number="001", project=project)
+        UserExperiment.objects.create(user=self.client_user, experiment=self.experiment,
+                                      type=UserInvolvementType.objects.get(name="Client"))
+
+        with self.settings(REPO_FILES_ROOT=self.repo):
+            exp_dir = self.experiment.experiment_dir
+        os.makedirs(os.path.join(exp_dir, "dir", "sub"))
+        for name in ["a.txt", "dir/sub/b.txt"]:
+            open(os.path.join(exp_dir, name), "w").close()
+        for filepath in ["Raw Data/a.txt", "Raw Data/dir", "Raw Data/dir/sub/b.txt",
+                         "Raw Data/deep/er/c.txt", "Other/d.txt"]:
+            ClientFile.objects.create(experiment=self.experiment, filepath=filepath,
+                                      sharedby=self.client_user)
+
+    def expand(self, node):
+        request = RequestFactory().get("/", {"node": node})
+        request.user = self.client_user
+        with self.settings(REPO_FILES_ROOT=self.repo):
+            return json.loads(recordsClientFiles(request).content)
+
+    def test_tree(self):
+        top = self.expand("exp%d" % self.experiment.id)
+        self.assertEqual([node["text"] for node in top], ["Other", "QC Data", "Raw Data"])
+        raw = top[2]
+        self.assertTrue(raw["metafile"])
+        self.assertEqual([(node["text"], node["leaf"]) for node in raw["children"]],
+                         [("a.txt", True), ("deep", False), ("dir", False)])
+
+        # folders which aren't shared come with their contents
+        deep = raw["children"][1]
+        self.assertEqual(deep["id"], None)
+        self.assertEqual(deep["children"][0]["children"][0]["text"], "c.txt")
+
+        # shared folders are expanded by id
+        shared_dir = ClientFile.objects.get(filepath="Raw Data/dir")
+        self.assertEqual(raw["children"][2]["id"], shared_dir.id)
+        sub = self.expand(str(shared_dir.id))
+        self.assertEqual([(node["text"], node["children"][0]["text"]) for node in sub],
+                         [("sub", "b.txt")])
+        self.assertEqual(self.expand("xnode-1"), [])
+
+    def test_cached(self):
+        node = "exp%d" % self.experiment.id
+        self.expand(node)
+
+        # the permission check and the cache key
+        with self.assertNumQueries(2):
+            self.expand(node)
+
+        ClientFile.objects.filter(filepath="Other/d.txt").delete()
+        top = self.expand(node)
+        self.assertEqual([node["text"] for node in top], ["QC Data", "Raw Data"])
+
+
+class ChunkedUploadTest(TestCase):
+    """
+    Tests uploading an experiment file in chunks, with a resume.
+    """
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix="testrepo-")
+        self.addCleanup(shutil.rmtree, self.repo)
+        forget_ensured_repo_dirs()
+        self.addCleanup(forget_ensured_repo_dirs)
+        self.user = User.objects.create(email="staff@example.com")
+        self.user.IsMastrStaff = True
+        project = Project.objects.create(title="Test Project", client=self.user)
+        self.experiment = Experiment.objects.create(title="Test Experiment", job_number="001", project=project)
+        self.data = os.urandom(1000)
+
+    def post(self, view, data):
+        request = RequestFactory().post("/", data)
+        request.user = User.objects.get(id=self.user.id)
+        with self.settings(REPO_FILES_ROOT=self.repo):
+            return json.loads(view(request).content)
+
+    def send(self, upload_id, offset, data):
+        return self.post(uploadFileChunk, {"upload_id": upload_id, "offset": str(offset),
+                                           "chunk": SimpleUploadedFile("blob", data)})
+
+    def test_upload(self):
+        upload = self.post(uploadFileStart, {"experimentId": str(self.experiment.id),
+                                             "name": "big data.pdf", "size": "1000"})
+        upload_id = upload["upload_id"]
+        self.assertEqual(upload["offset"], 0)
+
+        self.assertEqual(self.send(upload_id, 0, self.data[:400])["offset"], 400)
+        # a chunk from the wrong place is refused
+        self.assertFalse(self.send(upload_id, 600, self.data[600:])["success"])
+        # a chunk which was sent again is overwritten
+        self.assertEqual(self.send(upload_id, 300, self.data[300:700])["offset"], 700)
+
+        # the client resumes from where the upload got to
+        status = self.post(uploadFileStatus, {"upload_id": upload_id})
+        self.assertEqual((status["offset"], status["size"]), (700, 1000))
+        self.assertFalse(self.post(uploadFileCommit, {"upload_id": upload_id})["success"])
+        self.send(upload_id, status["offset"], self.data[700:])
+
+        self.assertTrue(self.post(uploadFileCommit, {"upload_id": upload_id})["success"])
+        with self.settings(REPO_FILES_ROOT=self.repo):
+            dest = os.path.join(self.experiment.other_files_dir, "big_data.pdf")
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertRaises(Http404, self.post, uploadFileStatus, {"upload_id": upload_id})
+
+    def test_other_user(self):
+        upload = self.post(uploadFileStart, {"experimentId": str(self.experiment.id), "name": "a.pdf"})
+        self.user = User.objects.create(email="other@example.com")
+        self.user.IsMastrStaff = True
+        self.assertRaises(Http404, self.send, upload["upload_id"], 0, "data")
+        self.assertRaises(Http404, self.post, uploadFileStatus, {"upload_id": "../../etc/passwd"})
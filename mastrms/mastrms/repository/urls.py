@@ -40,6 +40,10 @@ urlpatterns = [
     url(r'^moveFile[/]*$', views.moveFile),
     url(r'^deleteFile[/]*$', views.deleteFile),
     url(r'^uploadFile[/]*$', views.uploadFile),
+    url(r'^uploadFileStart[/]*$', views.uploadFileStart),
+    url(r'^uploadFileStatus[/]*$', views.uploadFileStatus),
+    url(r'^uploadFileChunk[/]*$', views.uploadFileChunk),
+    url(r'^uploadFileCommit[/]*$', views.uploadFileCommit),
     url(r'^newFolder[/]*$', views.newFolder),
     url(r'^uploadSampleCSV[/]*$', views.CSVUploadViewFile.as_view()),
     url(r'^uploadRunCaptureCSV[/]*$', views.CSVUploadViewCaptureCSV.as_view()),
@@ -60,6 +64,7 @@ urlpatterns = [
     url(r'^report_error[/]*$', views.report_error, name='report_error'),
     url(r'^remove_samples_from_run[/]*$', views.remove_samples_from_run, name='remove_samples_from_run'),
     url(r'^get_rule_generator[/]*$', views.get_rule_generator, name='get_rule_generator'),
+    url(r'^preview_rule_generator[/]*$', views.preview_rule_generator, name='preview_rule_generator'),
     url(r'^create_rule_generator[/]*$', views.create_rule_generator, name='create_rule_generator'),
     url(r'^edit_rule_generator[/]*$', views.edit_rule_generator, name='edit_rule_generator'),
     url(r'^clone_rule_generator[/]*$', views.clone_rule_generator, name='clone_rule_generator'),
@@ -3,12 +3,15 @@ import io
 import csv
 import re
 import logging
-import zipstream
 import json
+import time
+import uuid
 from decimal import Decimal, DecimalException
 from datetime import datetime, timedelta
-from itertools import groupby, chain
-from django.db.models import get_model, Q
+from itertools import product, islice
+from django.db import transaction
+from django.db.models import get_model, Q, Count, Max, F, Case, When, Value
+from django.core.cache import cache
 from django.core import urlresolvers
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.core.mail import mail_admins
@@ -16,15 +19,17 @@ from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseRedirect, HttpResponseBadRequest, HttpResponseServerError
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseRedirect, HttpResponseBadRequest, HttpResponseServerError, Http404
 from django.http import FileResponse, StreamingHttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.utils.encoding import smart_bytes, smart_text
-from mastrms.repository.models import Experiment, ExperimentStatus, Organ, AnimalInfo, HumanInfo, PlantInfo, MicrobialInfo, Treatment,  BiologicalSource, SampleClass, Sample, UserInvolvementType, SampleTimeline, UserExperiment, OrganismType, Project, SampleLog, Run, RUN_STATES, RunSample, InstrumentMethod, ClientFile, StandardOperationProcedure, RuleGenerator, Component, NodeClient
+from mastrms.repository.models import Experiment, ExperimentStatus, Organ, AnimalInfo, HumanInfo, PlantInfo, MicrobialInfo, Treatment,  BiologicalSource, SampleClass, Sample, UserInvolvementType, SampleTimeline, UserExperiment, OrganismType, Project, SampleLog, Run, RUN_STATES, RunSample, InstrumentMethod, ClientFile, StandardOperationProcedure, RuleGenerator, Component, NodeClient, deferred_sample_counts
 from mastrms.quote.models import Organisation, Formalquote
 from mastrms.decorators import mastr_users_only
 from json_util import makeJsonFriendly
-from mastrms.app.utils.data_utils import jsonResponse, zipdir, pack_files
+from mastrms.app.utils.data_utils import jsonResponse, zipstream_dir, stream_package
+from mastrms.app.utils.file_utils import list_dir, ensure_repo_filestore_dir_with_owner, set_repo_file_ownerships
+from mastrms.app.utils.download_utils import file_response
 from mastrms.repository.permissions import user_passes_test
 from mastrms.users.models import User
 from mastrms.repository import rulegenerators
@@ -156,87 +161,82 @@ def clone_experiment(base_experiment):
     '''
     base_exp = base_experiment
 
-    exp = Experiment()
-    exp.title = "%s (cloned)" % (base_exp.title)
-    exp.comment = base_exp.comment
-    exp.description = base_exp.description
-    exp.project = base_exp.project
-    exp.instrument_method = base_exp.instrument_method
-    exp.status = base_exp.status
-    exp.investigation = base_exp.investigation
-    exp.save()
-
-    #users need to be brought across if this is cloned
-    base_exp_users = UserExperiment.objects.filter(experiment=base_exp)
-    for base_exp_user in base_exp_users:
-        exp_user = UserExperiment(user=base_exp_user.user,
-                                    experiment=exp,
-                                    type=base_exp_user.type,
-                                    additional_info=base_exp_user.additional_info)
-        exp_user.save()
-    #Source
-    source = BiologicalSource(experiment=exp)
-    base_source = BiologicalSource.objects.get(experiment=base_exp)
-    source.type = base_source.type
-    source.save()
-
-    #Organs
-    base_organs = Organ.objects.filter(experiment=base_exp)
-    for base_organ in base_organs:
-        organ = Organ(experiment = exp)
-        organ.name = base_organ.name
-        organ.abbreviation = base_organ.abbreviation
-        organ.detail = base_organ.detail
-        organ.save()
+    with transaction.atomic():
+        exp = Experiment()
+        exp.title = "%s (cloned)" % (base_exp.title)
+        exp.comment = base_exp.comment
+        exp.description = base_exp.description
+        exp.project = base_exp.project
+        exp.instrument_method = base_exp.instrument_method
+        exp.status = base_exp.status
+        exp.investigation = base_exp.investigation
+        exp.save()
+
+        #users need to be brought across if this is cloned
+        base_exp_users = UserExperiment.objects.filter(experiment=base_exp)
+        UserExperiment.objects.bulk_create([
+            UserExperiment(user_id=base_exp_user.user_id,
+                           experiment=exp,
+                           type_id=base_exp_user.type_id,
+                           additional_info=base_exp_user.additional_info)
+            for base_exp_user in base_exp_users])
+        #Source
+        source = BiologicalSource(experiment=exp)
+        base_source = BiologicalSource.objects.get(experiment=base_exp)
+        source.type_id = base_source.type_id
+        source.save()
 
-    #Timelines
-    base_timelines = SampleTimeline.objects.filter(experiment=base_exp)
-    for base_timeline in base_timelines:
-        tl = SampleTimeline(experiment=exp,
-                            abbreviation=base_timeline.abbreviation,
-                            timeline = base_timeline.timeline)
-        tl.save()
-    #Treatments
-    base_treatments = Treatment.objects.filter(experiment=base_exp)
-    for base_treatment in base_treatments:
-        tr = Treatment(experiment = exp,
-                        abbreviation = base_treatment.abbreviation,
-                        name = base_treatment.name,
-                        description = base_treatment.description)
-        tr.save()
-
-    #Generate sample classes, and then generate samples
-    regenerate_sample_classes(exp.id)
-
-    #For each sample class, count all the samples which have that class.
-    base_sampleclasses = SampleClass.objects.filter(experiment=base_exp)
-    exp_sampleclasses = SampleClass.objects.filter(experiment=exp)
-    base_sampleclass_dict = {}
-    exp_sampleclass_dict = {}
-
-    #Build the dicts, keyed on the sample class name
-    #These should be unique, which should have been determined earlier by
-    #calling check_experiment_cloneable
-    for base_sampleclass in base_sampleclasses:
-        base_sampleclass_dict[base_sampleclass.__unicode__()]=base_sampleclass
-
-    for exp_sampleclass in exp_sampleclasses:
-        exp_sampleclass_dict[exp_sampleclass.__unicode__()] = exp_sampleclass
-
-    #Now generate samples for each:
-    for classname in base_sampleclass_dict.keys():
-        base_sampleclass = base_sampleclass_dict[classname]
-        exp_sampleclass = exp_sampleclass_dict.get(classname, None)
-        if exp_sampleclass is not None:
-            for orig in Sample.objects.filter(sample_class=base_sampleclass):
-                s = Sample()
-                s.sample_class = exp_sampleclass
-                s.label = orig.label
-                s.comment = orig.comment
-                s.weight = orig.weight
-                s.sample_class_sequence = orig.sample_class_sequence
-                s.experiment = exp
-                s.save()
+        #Organs
+        base_organs = Organ.objects.filter(experiment=base_exp)
+        Organ.objects.bulk_create([
+            Organ(experiment = exp,
+                  name = base_organ.name,
+                  abbreviation = base_organ.abbreviation,
+                  detail = base_organ.detail)
+            for base_organ in base_organs])
+
+        #Timelines
+        base_timelines = SampleTimeline.objects.filter(experiment=base_exp)
+        SampleTimeline.objects.bulk_create([
+            SampleTimeline(experiment=exp,
+                           abbreviation=base_timeline.abbreviation,
+                           timeline = base_timeline.timeline)
+            for base_timeline in base_timelines])
+        #Treatments
+        base_treatments = Treatment.objects.filter(experiment=base_exp)
+        Treatment.objects.bulk_create([
+            Treatment(experiment = exp,
+                      abbreviation = base_treatment.abbreviation,
+                      name = base_treatment.name,
+                      description = base_treatment.description)
+            for base_treatment in base_treatments])
+
+        #Generate sample classes, and then generate samples
+        regenerate_sample_classes(exp.id)
+
+        #Match up the sample classes, keyed on the sample class name
+        #These should be unique, which should have been determined earlier by
+        #calling check_experiment_cloneable
+        components = ("biological_source", "organ", "timeline", "treatments")
+        base_sampleclasses = SampleClass.objects.filter(experiment=base_exp).select_related(*components)
+        exp_sampleclasses = SampleClass.objects.filter(experiment=exp).select_related(*components)
+        exp_sampleclass_dict = dict((sc.__unicode__(), sc) for sc in exp_sampleclasses)
+        sampleclass_map = {}
+        for base_sampleclass in base_sampleclasses:
+            exp_sampleclass = exp_sampleclass_dict.get(base_sampleclass.__unicode__(), None)
+            if exp_sampleclass is not None:
+                sampleclass_map[base_sampleclass.id] = exp_sampleclass
+
+        #Now copy the samples of each class
+        base_samples = Sample.objects.filter(sample_class__in=sampleclass_map.keys()).order_by("id")
+        Sample.objects.bulk_create([
+            Sample(sample_class = sampleclass_map[orig.sample_class_id],
+                   label = orig.label,
+                   comment = orig.comment,
+                   weight = orig.weight,
+                   sample_class_sequence = orig.sample_class_sequence,
+                   experiment = exp)
+            for orig in base_samples])
 
     return exp
 
@@ -289,34 +289,33 @@ def create_experiment(user, attributes, base_experiment_id = None):
 def clone_run(request, run_id):
     result = {'success':False, 'message':"None", 'data':None}
     try:
-        base_run = Run.objects.get(id=run_id)
-        new_run = Run()
-        new_run.experiment        = base_run.experiment
-        new_run.method            = base_run.method
-        new_run.creator           = base_run.creator
-        new_run.title             = "%s (cloned)" % (base_run.title)
-        new_run.machine           = base_run.machine
-        new_run.generated_output  = base_run.generated_output
-        new_run.state             = RUN_STATES.NEW[0]
-        new_run.rule_generator    = base_run.rule_generator
-        new_run.number_of_methods = base_run.number_of_methods
-        new_run.order_of_methods  = base_run.order_of_methods
-        new_run.save()
-
-        #samples
-        base_rs = RunSample.objects.filter(run=base_run)
-        for base_runsample in base_rs:
-            new_runsample               = RunSample(run=new_run)
-            new_runsample.sample        = base_runsample.sample
-            new_runsample.component     = base_runsample.component
-            new_runsample.sequence      = base_runsample.sequence
-            new_runsample.vial_number   = base_runsample.vial_number
-            new_runsample.method_number = base_runsample.method_number
-            new_runsample.save()
-
-        #sample count
-        #incomplete sample count
-        #complete sample count
+        with transaction.atomic():
+            base_run = Run.objects.get(id=run_id)
+            new_run = Run()
+            new_run.experiment        = base_run.experiment
+            new_run.method            = base_run.method
+            new_run.creator           = base_run.creator
+            new_run.title             = "%s (cloned)" % (base_run.title)
+            new_run.machine           = base_run.machine
+            new_run.generated_output  = base_run.generated_output
+            new_run.state             = RUN_STATES.NEW[0]
+            new_run.rule_generator    = base_run.rule_generator
+            new_run.number_of_methods = base_run.number_of_methods
+            new_run.order_of_methods  = base_run.order_of_methods
+            new_run.save()
+
+            #samples
+            base_rs = RunSample.objects.filter(run=base_run).order_by("id")
+            new_rs = [RunSample(run           = new_run,
+                                sample_id     = base_runsample.sample_id,
+                                component_id  = base_runsample.component_id,
+                                sequence      = base_runsample.sequence,
+                                vial_number   = base_runsample.vial_number,
+                                method_number = base_runsample.method_number)
+                      for base_runsample in base_rs]
+            RunSample.objects.bulk_create(new_rs)
+            if new_rs:
+                new_run.update_sample_counts()
 
         result['success'] = True
         result['data'] = {'id':new_run.id}
@@ -358,20 +357,59 @@ def create_sample_log(request, sample_id, type, description):
 
 @mastr_users_only
 def batch_create_sample_logs(request):
-    #get args and remove the id from it if it exists
+    """
+    Stamps the same log entry on many samples at once. Samples the
+    user can't access are skipped, and the result for each sample is
+    returned so the grid can refresh just those rows.
+    """
     if request.GET:
         args = request.GET
     else:
         args = request.POST
 
-    #todo stuff
-    type = args.get('type')
-    description = args.get('description')
-    sampleids = args.get('sample_ids').split(',')
+    try:
+        type = int(args.get('type'))
+        sample_ids = [int(X) for X in args.get('sample_ids', '').split(',') if X]
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid type or sample_ids.\n")
+    if type not in dict(SampleLog.LOG_TYPES):
+        return HttpResponseBadRequest("Unknown log type %d.\n" % type)
+    description = args.get('description', '')
+
+    samples = Sample.objects.filter(id__in=sample_ids)
+    if not request.user.is_superuser:
+        samples = samples.filter(Q(experiment__users=request.user)|Q(experiment__project__managers=request.user))
+    permitted = set(samples.values_list('id', flat=True).distinct())
+
+    with transaction.atomic():
+        SampleLog.objects.bulk_create([
+            SampleLog(type=type, description=description, sample_id=sample_id, user=request.user)
+            for sample_id in sample_ids if sample_id in permitted])
+        Sample.update_last_logs(permitted)
+
+    statuses = dict((sample.id, sample.last_status) for sample in
+                    Sample.objects.filter(id__in=permitted).select_related('last_log'))
+
+    output = {'metaData': { 'totalProperty': 'results',
+                            'successProperty': 'success',
+                            'root': 'rows',
+                            'id': 'id',
+                            'fields': [{'name':'id'}, {'name':'success'}, {'name':'last_status'}, {'name':'msg'}]
+                            },
+              'results': len(sample_ids),
+              'authenticated': True,
+              'authorized': True,
+              'success': True,
+              'rows': []
+              }
+
+    for sample_id in sample_ids:
+        if sample_id in statuses:
+            output['rows'].append({'id': sample_id, 'success': True, 'last_status': statuses[sample_id]})
+        else:
+            output['rows'].append({'id': sample_id, 'success': False, 'msg': 'Sample not found or not permitted'})
 
-    for sampleid in sampleids:
-        create_sample_log(request, sampleid, type, description)
-    return records(request, 'samplelog', 'id', 0)
+    return HttpResponse(json.dumps(output))
 
 
 @mastr_users_only
@@ -713,50 +751,67 @@ def recordsClientList(request):
     output = makeJsonFriendly(output)
     return HttpResponse(json.dumps(output))
 
-def _merge_duplicate_entries(entries):
-    "Merges duplicate folders within an extjs node tree."
-    merged = []
-    text = lambda e: e["text"]
-    entries.sort(key=text)
-    for k, items in groupby(entries, text):
-        items = list(items)
-        head = items[0]
-        children = list(chain(*(item.get("children", []) or [] for item in items)))
-        head["children"] = _merge_duplicate_entries(children) if children else None
-        merged.append(head)
-    return merged
-
-def _client_files_subtree(client_files, path):
+def _client_files_tree(experiment):
     """
-    Produces an extjs node tree for the client_files queryset, within
-    the subtree given by path.
+    Builds the extjs node tree of an experiment's shared files from a
+    single query. The tree is a dict mapping each shared file id (and
+    "" for the top level) to the list of nodes inside it. Shared files
+    are expanded on demand by id, while folders which aren't shared
+    have their contents filled in.
     """
-    entries = []
-    client_files = client_files.filter(filepath__startswith=path)
-
-    for client_file in client_files:
-        text = client_file.filepath[len(path):]
-        subfiles = client_files.filter(filepath__startswith=client_file.filepath + "/")
-        if "/" not in text:
-            filepath = real_file_path(client_file.experiment, client_file.filepath)
-            entries.append({
-                'text': text,
-                'leaf': filepath is not None and not os.path.isdir(filepath),
-                'id': client_file.id,
-            })
-        elif not subfiles.exists():
-            # create parent folders for this entry
-            entry = None
-            for part in reversed(client_file.filepath[len(path):].split("/")):
-                entry = {
-                    'id': client_file.id if entry is None else None,
-                    'text': part,
-                    'leaf': entry is None,
-                    'children': [entry] if entry else None,
-                }
-            entries.append(entry)
-
-    return entries
+    root = {"id": None, "children": {}}
+    files = ClientFile.objects.filter(experiment=experiment).order_by("filepath", "id")
+    for client_file_id, filepath in files.values_list("id", "filepath"):
+        node = root
+        for part in filepath.strip("/").split("/"):
+            node = node["children"].setdefault(part, {"id": None, "children": {}})
+        if node["id"] is None:
+            node["id"] = client_file_id
+            node["path"] = filepath
+
+    tree = {}
+
+    def entries(node):
+        return [entry(text, child) for text, child in sorted(node["children"].iteritems())]
+
+    def entry(text, node):
+        if node["id"] is None:
+            return {'id': None, 'text': text, 'leaf': False, 'children': entries(node)}
+        tree[node["id"]] = entries(node)
+        if node["children"]:
+            leaf = False
+        else:
+            filepath = real_file_path(experiment, node["path"])
+            leaf = filepath is not None and not os.path.isdir(filepath)
+        return {'id': node["id"], 'text': text, 'leaf': leaf, 'children': None}
+
+    # the 2 standard folders are always there
+    top = [{
+        "text": folder,
+        "leaf": False,
+        "metafile": True,
+        "children": entries(root["children"].pop(folder, {"children": {}})),
+    } for folder in ("Raw Data", "QC Data")]
+    tree[""] = sorted(top + entries(root), key=lambda e: e["text"])
+
+    return tree
+
+CLIENT_FILES_TREE_CACHE_TIMEOUT = 60 * 60
+
+def _client_files_tree_cached(experiment):
+    """
+    Returns the client files tree of an experiment from the cache. The
+    cache key changes whenever files are shared, unshared or renamed.
+    """
+    files = ClientFile.objects.filter(experiment=experiment)
+    state = files.aggregate(count=Count("id"), last_id=Max("id"), last_shared=Max("sharetimestamp"))
+    key = "client_files_tree:%s:%s:%s:%s" % (experiment.id, state["count"], state["last_id"],
+                                             state["last_shared"] and state["last_shared"].isoformat())
+    tree = cache.get(key)
+    if tree is None:
+        tree = _client_files_tree(experiment)
+        cache.set(key, tree, CLIENT_FILES_TREE_CACHE_TIMEOUT)
+    return tree
 
 def _client_files_experiments(client_files):
     "Makes an extjs tree node list of experiments which the client has access to"
@@ -770,29 +825,22 @@ def _client_files_experiments(client_files):
 
 def _client_files_list(client_files, nodeid):
     if nodeid.startswith("exp"):
-        # Experiment top level -- seed list with the 2 standard folders.
-        exp_id = nodeid[3:]
-        client_files = client_files.filter(experiment_id=exp_id)
-        path = ""
-        output = [{
-            "text": folder,
-            "leaf": False,
-            "metafile": True,
-            "children": _client_files_subtree(client_files, folder + "/"),
-        } for folder in ("Raw Data", "QC Data")]
+        # Experiment top level
+        client_files = client_files.filter(experiment_id=nodeid[3:]).select_related("experiment")[:1]
+        if not client_files:
+            return []
+        experiment = client_files[0].experiment
+        key = ""
     elif nodeid.startswith("xnode"):
         # if nodeid is an xnode then client wants to expand an empty node
         return []
     else:
         # Sub-folder within an experiment
-        client_file = client_files.get(id=nodeid)
-        client_files = client_files.filter(experiment_id=client_file.experiment_id)
-        path = client_file.filepath + "/"
-        output = []
-
-    output.extend(_client_files_subtree(client_files, path))
+        client_file = client_files.select_related("experiment").get(id=nodeid)
+        experiment = client_file.experiment
+        key = client_file.id
 
-    return _merge_duplicate_entries(output)
+    return _client_files_tree_cached(experiment).get(key, [])
 
 def recordsClientFiles(request):
     root = 'dashboardFilesRoot'
@@ -1016,105 +1064,58 @@ def recreate_sample_classes(request, experiment_id):
     return recordsSampleClasses(request, experiment_id)
 
 def regenerate_sample_classes(experiment_id):
-    combos = []
-
-    for biosource in BiologicalSource.objects.filter(experiment__id=experiment_id):
-        combosForBioSource = []
-        for organ in Organ.objects.filter(experiment__id=experiment_id):
-            combosForOrgan = []
-
-            base = { 'bs': biosource.id, 'o': organ.id }
-            bcombos = [base]
-
-            combosForTreatment = []
-            for treatment in Treatment.objects.filter(experiment__id=experiment_id):
-                for combo in bcombos:
-                    tmp = combo.copy()
-                    tmp['treatment'] = treatment.id
-                    combosForTreatment.append(tmp.copy())
-            if len(combosForTreatment) == 0:
-                combosForTreatment = bcombos[:]
-
-            combosForOrgan = combosForTreatment[:]
-
-            combosForTimeline = []
-            for timeline in SampleTimeline.objects.filter(experiment__id=experiment_id):
-                for combo in combosForOrgan:
-                    tmp = combo.copy()
-                    tmp['time'] = timeline.id
-                    combosForTimeline.append(tmp.copy())
-            if len(combosForTimeline) > 0:
-                combosForOrgan = combosForTimeline[:]
-
-            combosForBioSource = combosForBioSource + combosForOrgan
-
-        combos = combos + combosForBioSource
-
+    """
+    Makes a sample class for every combination of the experiment's
+    biological sources, organs, timelines and treatments, keeping the
+    classes which already exist and deleting the ones which no longer
+    match a combination. The samples of each class are renumbered.
+    """
+    biosources = BiologicalSource.objects.filter(experiment__id=experiment_id)
+    organs = Organ.objects.filter(experiment__id=experiment_id)
+    treatments = list(Treatment.objects.filter(experiment__id=experiment_id)) or [None]
+    timelines = list(SampleTimeline.objects.filter(experiment__id=experiment_id)) or [None]
+    combos = product(biosources, organs, timelines, treatments)
 
-    #iterate over combos and current sampleclasses
+    #index the current sampleclasses on their components
     #if they already exist, fine
     #if they no longer exist, delete
     #if they don't exist, create
     currentsamples = SampleClass.objects.filter(experiment__id = experiment_id)
-            #    print currentsamples[0]
+    current = currentsamples.select_related("biological_source", "organ", "timeline", "treatments")
+    existing = {}
+    for sc in current.order_by("id"):
+        key = (sc.biological_source_id, sc.organ_id, sc.timeline_id, sc.treatments_id)
+        existing.setdefault(key, sc)
 
-    #determine what to delete and what to add
     foundclasses = set()
-
-    for combo in combos:
-        #look for item in currentsamples, if it exists, add it to the foundclasses set
-
-        a = currentsamples
-
-        #item for adding
-        sc = SampleClass()
-        sc.experiment_id = experiment_id
-        sc.class_id = 'sample class'
-
-        b = ''
-        for key in combo.keys():
-            if key == 'treatment':
-                sc.treatments_id = combo[key]
-                a = a.filter(treatments__id = combo[key])
-            elif key == 'bs':
-                sc.biological_source_id = combo[key]
-                a = a.filter(biological_source__id = combo[key])
-            elif key == 'o':
-                sc.organ_id = combo[key]
-                a = a.filter(organ__id = combo[key])
-            elif key == 'time':
-                sc.timeline_id = combo[key]
-                a = a.filter(timeline__id = combo[key])
-            b = b + ' ' + str(key) + ' ' + str(combo[key])
-
-            #        print 'filtering with '+b
-
-        if a:
-            combo['id'] = a[0].id
-            foundclasses.add(a[0].id)
-            sc = a[0]
-                #            print 'found'
+    newclasses = []
+    for bs, organ, timeline, treatment in combos:
+        key = (bs.id, organ.id, getattr(timeline, "id", None), getattr(treatment, "id", None))
+        sc = existing.get(key)
+        if sc is None:
+            sc = SampleClass(experiment_id=experiment_id, biological_source=bs,
+                             organ=organ, timeline=timeline, treatments=treatment)
+            #auto-assign a name based on abbreviations
+            sc.class_id = sc.component_abbreviations()
+            newclasses.append(sc)
         else:
-            #if not found, add it on the spot
-            sc.save()
             foundclasses.add(sc.id)
-        #now check if we can auto-assign a name based on abbreviations
-        if str(sc) != '':
-            sc.class_id = str(sc)
-            sc.save()
-
-        #renumber all the samples
-        count = 1
-        for sample in sc.sample_set.all().order_by('sample_class_sequence', 'id'):
-            sample.sample_class_sequence = count
-            count = count + 1
-            sample.save()
+            if sc.class_id != unicode(sc):
+                SampleClass.objects.filter(id=sc.id).update(class_id=unicode(sc))
 
     #purge anything not in foundclasses
     purgeable = currentsamples.exclude(id__in=foundclasses)
     purgeable.delete()
 
+    SampleClass.objects.bulk_create(newclasses)
+    #classes without abbreviations are named after their id, which
+    #they only have once they are saved
+    if any(sc.class_id == '' for sc in newclasses):
+        for sc in currentsamples.filter(class_id=''):
+            SampleClass.objects.filter(id=sc.id).update(class_id=unicode(sc))
 
+    #renumber all the samples
+    SampleClass.renumber_samples(experiment_id)
 
 @mastr_users_only
 def recordsSampleClasses(request, experiment_id):
@@ -1147,6 +1148,7 @@ def recordsSampleClasses(request, experiment_id):
 
 
     rows = SampleClass.objects.filter(experiment__id=experiment_id)
+    rows = rows.select_related("treatments", "timeline", "organ").annotate(count=Count('sample'))
 
     # add row count
     output['results'] = len(rows);
@@ -1169,7 +1171,7 @@ def recordsSampleClasses(request, experiment_id):
         if row.organ:
             d['organ'] = row.organ.name
 
-        d['count'] = row.sample_set.count()
+        d['count'] = row.count
 
         output['rows'].append(d)
 
@@ -1188,6 +1190,7 @@ def recordsSamplesForExperiment(request):
 
     # basic json that we will fill in
     output = {'metaData': {
+                  'totalProperty': 'results',
                   'successProperty': 'success',
                   'root': 'rows',
                   'idProperty': 'id',
@@ -1221,31 +1224,33 @@ def recordsSamplesForExperiment(request):
                         }, {
                             "type": "int",
                             "name": "sample_class_sequence"
+                        }, {
+                            "type": "string",
+                            "name": "last_status"
                         }
                     ],
                 },
+             'results': 0,
              'rows': []}
 
     experiment_id = args['experiment__id__exact']
     rows = Sample.objects.filter(experiment__id=experiment_id)
+    rows = rows.select_related("experiment", "last_log", *SAMPLE_CLASS_RELATED)
 
     randomise = args.get('randomise', False)
 
+    if randomise:
+        sort_fields, default_sort = {}, ('?',)
+        # each page would be a separate random draw, so the whole
+        # shuffled list is sent at once
+        args = dict((k, v) for k, v in args.items() if k not in ('start', 'limit'))
+    else:
+        sort_fields = SAMPLE_SORT_FIELDS
+        #sort by default on sample class, and
+        #always sort with sequence second (mostly will be for class).
+        default_sort = ('sample_class__class_id', 'sample_class_sequence')
 
-    if not randomise:
-        sort_by = args.get('sort', 'sample_class') #sort by default on sample class
-        if sort_by == 'sample_class':
-            sort_by = 'sample_class__class_id'
-        sort_dir = args.get('dir', 'ASC')
-        if sort_dir == 'DESC':
-            sort1 = '-' + sort_by
-        else:
-            sort1 = sort_by
-
-        #Always sort with sequence second (mostly will be for class).
-        sort2 = 'sample_class_sequence'
-
-        rows = rows.order_by(sort1, sort2)
+    output['results'], rows = query_records(rows, args, sort_fields, default_sort, SAMPLE_FILTER_FIELDS)
 
     # add rows
     for row in rows:
@@ -1260,16 +1265,105 @@ def recordsSamplesForExperiment(request):
         d['experiment__unicode'] = unicode(row.experiment)
         d['id'] = row.id
         d['sample_class'] = row.sample_class.id if row.sample_class else None
+        d['last_status'] = row.last_status
 
         output['rows'].append(d)
 
-    if randomise:
-        import random
-        random.shuffle(output['rows'])
-
     output = makeJsonFriendly(output)
     return HttpResponse(json.dumps(output))
 
+# sample classes are named after their components
+SAMPLE_CLASS_RELATED = ("sample_class__biological_source", "sample_class__organ",
+                        "sample_class__timeline", "sample_class__treatments")
+
+def query_records(rows, args, sort_fields={}, default_sort=(), filter_fields={}):
+    """
+    Applies the filtering, sorting and paging asked for by an ExtJS
+    store to a queryset of records. Returns the number of matching
+    records and the requested page of them.
+
+    sort_fields maps the field names which may be sorted on to the
+    model fields to order by, and filter_fields maps request params
+    to the lookups used to filter on them. If the store doesn't send
+    a limit, all the records are returned.
+    """
+    for param, lookup in filter_fields.items():
+        value = args.get(param)
+        if value not in (None, ''):
+            try:
+                rows = rows.filter(**{lookup: value})
+            except ValueError:
+                # nothing can match a value of the wrong type
+                rows = rows.none()
+
+    sort_by = sort_fields.get(args.get('sort'))
+    if sort_by is not None:
+        if args.get('dir', 'ASC').upper() == 'DESC':
+            sort_by = '-' + sort_by
+        rows = rows.order_by(sort_by, *default_sort)
+    elif default_sort:
+        rows = rows.order_by(*default_sort)
+
+    try:
+        start = max(int(args.get('start', 0)), 0)
+        limit = int(args.get('limit', 0))
+    except ValueError:
+        start, limit = 0, 0
+
+    if limit > 0:
+        return rows.count(), rows[start:start + limit]
+    rows = list(rows)
+    return len(rows), rows
+
+# The fields which the record views can be sorted and filtered on
+SAMPLE_SORT_FIELDS = {
+    'id': 'id',
+    'sample_id': 'sample_id',
+    'label': 'label',
+    'comment': 'comment',
+    'weight': 'weight',
+    'sample_class': 'sample_class__class_id',
+    'sample_class__unicode': 'sample_class__class_id',
+    'sample_class_sequence': 'sample_class_sequence',
+    'experiment': 'experiment__id',
+    'experiment__unicode': 'experiment__title',
+}
+SAMPLE_FILTER_FIELDS = {
+    'label': 'label__icontains',
+    'sample_class': 'sample_class__id',
+}
+RUN_SORT_FIELDS = {
+    'id': 'id',
+    'title': 'title',
+    'state': 'state',
+    'created_on': 'created_on',
+    'sample_count': 'sample_count',
+    'complete_sample_count': 'complete_sample_count',
+    'incomplete_sample_count': 'incomplete_sample_count',
+    'machine__unicode': 'machine__station_name',
+    'method__unicode': 'method__title',
+    'creator__unicode': 'creator__email',
+    'experiment__unicode': 'experiment__title',
+}
+RUN_FILTER_FIELDS = {
+    'title': 'title__icontains',
+    'state': 'state',
+    'machine': 'machine__id',
+}
+EXPERIMENT_SORT_FIELDS = {
+    'id': 'id',
+    'status': 'status__id',
+    'status_text': 'status__name',
+    'title': 'title',
+    'job_number': 'job_number',
+    'description': 'description',
+}
+EXPERIMENT_FILTER_FIELDS = {
+    'title': 'title__icontains',
+    'job_number': 'job_number__icontains',
+    'status': 'status__id',
+}
+
 def json_records_template(fields):
     fields_list = [{'name': f} for f in fields]
     return {
@@ -1313,11 +1407,12 @@ def recordsRuns(request):
             condition = extra_condition
 
     if condition:
-        rows = Run.objects.filter(condition)
+        rows = Run.objects.filter(condition).distinct()
     else:
         rows = Run.objects.all()
+    rows = rows.select_related("machine", "method", "creator", "experiment")
 
-    output['results'] = len(rows)
+    output['results'], rows = query_records(rows, args, RUN_SORT_FIELDS, ('id',), RUN_FILTER_FIELDS)
 
     # add rows
     for row in rows:
@@ -1359,15 +1454,10 @@ def recordsSamplesForRun(request):
 
     run_id = args['run_id']
     rows = Sample.objects.filter(run__id=run_id)
+    rows = rows.select_related("experiment", *SAMPLE_CLASS_RELATED)
 
-    sort_by = args.get('sort', 'runsample__sequence')
-    sort_dir = args.get('dir', 'ASC')
-    if sort_dir == 'DESC':
-        sort = '-' + sort_by
-    else:
-        sort = sort_by
-
-    rows = rows.order_by(sort)
+    sort_fields = dict(SAMPLE_SORT_FIELDS, runsample__sequence='runsample__sequence')
+    output['results'], rows = query_records(rows, args, sort_fields, ('runsample__sequence',), SAMPLE_FILTER_FIELDS)
 
     # add rows
     for row in rows:
@@ -1472,9 +1562,16 @@ def recordsExperimentsForProject(request, project_id):
 
     if project_id is not None:
         rows = rows.filter(project__id=project_id)
+    rows = rows.select_related("status")
 
     # add row count
-    output['results'] = len(rows);
+    output['results'], rows = query_records(rows, args, EXPERIMENT_SORT_FIELDS, ('status__id', 'id'), EXPERIMENT_FILTER_FIELDS)
+
+    # look up the first client and principal of each experiment in one go
+    involvements = UserExperiment.objects.filter(type__id__in=(1, 3), experiment__in=[row.id for row in rows])
+    emails = {}
+    for ue in involvements.select_related('user').order_by('id'):
+        emails.setdefault((ue.experiment_id, ue.type_id), ue.user.email)
 
     # add rows
     for row in rows:
@@ -1485,14 +1582,8 @@ def recordsExperimentsForProject(request, project_id):
         d['title'] = row.title
         d['description'] = row.description
         d['job_number'] = row.job_number
-        try:
-            d['client'] = UserExperiment.objects.filter(type__id=3, experiment__id=row.id)[0].user.email
-        except:
-            d['client'] = ''
-        try:
-            d['principal'] = UserExperiment.objects.filter(type__id=1, experiment__id=row.id)[0].user.email
-        except:
-            d['principal'] = ''
+        d['client'] = emails.get((row.id, 3), '')
+        d['principal'] = emails.get((row.id, 1), '')
 
         output['rows'].append(d)
 
@@ -1547,10 +1638,10 @@ def recordsSamples(request, experiment_id):
               'rows': []
               }
 
-    rows = Experiment.objects.get(id=experiment_id).sample_set.all()
+    rows = Sample.objects.filter(experiment__id=experiment_id).select_related("last_log")
 
     # add row count
-    output['results'] = len(rows);
+    output['results'], rows = query_records(rows, args, SAMPLE_SORT_FIELDS, ('id',), SAMPLE_FILTER_FIELDS)
 
     # add rows
     for row in rows:
@@ -1560,11 +1651,7 @@ def recordsSamples(request, experiment_id):
         d['weight'] = row.weight
         d['comment'] = row.comment
         d['sample_class'] = row.sample_class_id
-        try:
-            status = row.samplelog_set.all().order_by('-changetimestamp')[0]
-            d['last_status'] = str(status)
-        except:
-            d['last_status'] = ''
+        d['last_status'] = row.last_status
 
         output['rows'].append(d)
 
@@ -1596,10 +1683,11 @@ def recordsSamplesForClient(request, client):
               'rows': []
               }
 
-    rows = Sample.objects.filter(experiment__users__email=client)
+    rows = Sample.objects.filter(experiment__users__email=client).distinct().select_related("experiment", "last_log")
 
     # add row count
-    output['results'] = len(rows);
+    sort_fields = dict(SAMPLE_SORT_FIELDS, experiment_id='experiment__id', experiment_title='experiment__title')
+    output['results'], rows = query_records(rows, args, sort_fields, ('id',), SAMPLE_FILTER_FIELDS)
 
     # add rows
     for row in rows:
@@ -1611,11 +1699,7 @@ def recordsSamplesForClient(request, client):
         d['sample_class'] = row.sample_class_id
         d['experiment_id'] = row.experiment_id
         d['experiment_title'] = row.experiment.title
-        try:
-            status = row.samplelog_set.all().order_by('-changetimestamp')[0]
-            d['last_status'] = str(status)
-        except:
-            d['last_status'] = ''
+        d['last_status'] = row.last_status
 
         output['rows'].append(d)
 
@@ -1860,24 +1944,26 @@ def _fileList(basepath, subdir="", sharedList=None, replace_subdir=None, prefix=
     files_dir = os.path.join(basepath, subdir)
 
     #verify that there is no up-pathing hack happening
-    if not files_dir.startswith(basepath) or not os.path.isdir(files_dir):
+    if not files_dir.startswith(basepath):
         return []
 
-    for filename in sorted(os.listdir(files_dir)):
-        filepath = os.path.join(files_dir, filename)
-
-        if os.access(filepath, os.R_OK):
-            nodeid = os.path.join(replace_subdir or subdir, filename)
-            if prefix:
-                nodeid = os.path.join(prefix, nodeid)
-            entry = {
-                'text': filename,
-                'leaf': not os.path.isdir(filepath),
-                'id': nodeid,
-            }
-            if sharedList is not None:
-                entry["checked"] = entry["id"] in sharedList
-            output.append(entry)
+    try:
+        filenames = list_dir(files_dir)
+    except OSError:
+        return []
+
+    for filename, is_dir in filenames:
+        nodeid = os.path.join(replace_subdir or subdir, filename)
+        if prefix:
+            nodeid = os.path.join(prefix, nodeid)
+        entry = {
+            'text': filename,
+            'leaf': not is_dir,
+            'id': nodeid,
+        }
+        if sharedList is not None:
+            entry["checked"] = entry["id"] in sharedList
+        output.append(entry)
 
     return output
 
@@ -1943,20 +2029,28 @@ def packageFilesForDownload(request):
 
     request.session[package_name] = {
         'experiment_id': exp.id,
-        'files': normalise_files(exp, files)
+        'files': normalise_files(exp, files),
+        'compress': _download_compress(args),
     }
     return HttpResponse(json.dumps({
                 'success':True,
                 'package_name': package_name
         }))
 
-def fileDownloadResponse(realfile, filename=None):
-    if filename is None:
-        filename = os.path.basename(realfile)
-    response = FileResponse(open(realfile, "rb"), content_type='application/download')
-    response['Content-Disposition'] = 'attachment;  filename=\"%s\"' % filename
+def fileDownloadResponse(request, realfile, filename=None):
+    return file_response(request, realfile, filename)
+
+def dirDownloadResponse(realdir, name, compress=True):
+    "Streams a zip of the directory, built as it's sent."
+    zipped = zipstream_dir(realdir, compress=compress)
+    response = StreamingHttpResponse(zipped, content_type='application/download')
+    response['Content-Disposition'] = 'attachment;  filename=\"%s.zip\"' % name
     return response
 
+def _download_compress(args):
+    "Instrument data is stored rather than deflated if the store arg is given."
+    return args.get('store', '') not in ('1', 'true')
+
 @mastr_users_only
 def downloadPackage(request):
     package_name = request.REQUEST.get('packageName')
@@ -1965,11 +2059,10 @@ def downloadPackage(request):
     experiment_id = package_info.get('experiment_id')
     experiment = get_object_or_404(Experiment, pk=experiment_id)
 
-    zipped = zipstream.ZipFile(mode="w", compression=zipstream.ZIP_DEFLATED)
-    for f in files:
-        zipped.write(f[0])
+    package = stream_package(files, package_name, package_info.get('compress', True),
+                             threaded=settings.DOWNLOAD_PACKAGE_THREADED)
 
-    response = StreamingHttpResponse(zipped, content_type='application/download')
+    response = StreamingHttpResponse(package, content_type='application/download')
     response['Content-Disposition'] = 'attachment; filename={}'.format(package_name)
     return response
 
@@ -1985,12 +2078,9 @@ def downloadFile(request, *args):
     name = os.path.basename(filename)
 
     if os.path.isdir(filename):
-        tmpfilename = "/tmp/madas-zip-"+name
-        zipdir(filename, tmpfilename)
-        filename = tmpfilename
-        name = name + ".zip"
+        return dirDownloadResponse(filename, name, _download_compress(args))
 
-    return fileDownloadResponse(filename, name)
+    return fileDownloadResponse(request, filename, name)
 
 @mastr_users_only
 def downloadSOPFileById(request, sop_id):
@@ -2029,17 +2119,9 @@ def downloadClientFile(request, filepath):
         outputname = os.path.basename(filename)
 
         if os.path.isdir(filename):
-            tmpfilename = "/tmp/madas-zip-"+outputname
-            zipdir(filename, tmpfilename)
-            filename = tmpfilename
-            outputname = outputname + ".zip"
-
-        from django.core.files import File
-        wrapper = File(open(filename, "rb"))
-        content_disposition = 'attachment;  filename=\"%s\"' % outputname
-        response = HttpResponse(wrapper, content_type='application/download')
-        response['Content-Disposition'] = content_disposition
-        response['Content-Length'] = os.path.getsize(filename)
+            return dirDownloadResponse(filename, outputname, _download_compress(request.REQUEST))
+
+        response = fileDownloadResponse(request, filename, outputname)
     else:
         response = HttpResponseNotFound("Cannot download file")
 
@@ -2057,18 +2139,12 @@ def downloadRunFile(request):
     logger.debug('download run file: ' + filename)
 
     if os.path.isdir(filename):
-        tmpfilename = "/tmp/madas-zip-"+name
-        zipdir(filename, tmpfilename)
-        filename = tmpfilename
-        name += ".zip"
-
-    from django.core.files import File
-    wrapper = File(open(filename, "rb"))
-    content_disposition = 'attachment;  filename=\"%s\"' % name
-    response = HttpResponse(wrapper, content_type='application/download')
-    response['Content-Disposition'] = content_disposition
-    response['Content-Length'] = os.path.getsize(filename)
-    return response
+        return dirDownloadResponse(filename, name, _download_compress(args))
+
+    if not os.path.isfile(filename):
+        return HttpResponseNotFound("Cannot download file")
+
+    return fileDownloadResponse(request, filename, name)
 
 
 
@@ -2145,6 +2221,157 @@ def _handle_uploaded_file(f, name, experiment_id, parent_folder):
     logger.debug('*** _handle_uploaded_file: exit ***')
     return retval
 
+# Chunked uploads are staged in this directory within the repo, along
+# with a json file describing where each one is going.
+UPLOAD_STAGING_DIR = "upload-staging"
+UPLOAD_STAGING_MAX_AGE = timedelta(days=7)
+UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+def _upload_staging_path(upload_id, ext):
+    return os.path.join(settings.REPO_FILES_ROOT, UPLOAD_STAGING_DIR, "%s.%s" % (upload_id, ext))
+
+def _expire_staged_uploads():
+    "Removes the staging files of uploads which were abandoned long ago."
+    staging_dir = os.path.join(settings.REPO_FILES_ROOT, UPLOAD_STAGING_DIR)
+    expiry = time.time() - UPLOAD_STAGING_MAX_AGE.total_seconds()
+    for filename in os.listdir(staging_dir):
+        path = os.path.join(staging_dir, filename)
+        try:
+            if os.path.getmtime(path) < expiry:
+                os.remove(path)
+        except OSError:
+            pass
+
+def _staged_upload(request):
+    """
+    Returns the upload_id of a chunked upload along with its details,
+    or raises Http404 if the user has no such upload in progress.
+    """
+    upload_id = request.POST.get('upload_id', '')
+    if not UPLOAD_ID_RE.match(upload_id):
+        raise Http404("Unknown upload")
+    try:
+        with open(_upload_staging_path(upload_id, "json")) as f:
+            upload = json.load(f)
+    except IOError:
+        raise Http404("Unknown upload")
+    if upload['user_id'] != request.user.id:
+        raise Http404("Unknown upload")
+    return upload_id, upload
+
+def _upload_response(upload_id, **kwargs):
+    output = {
+        'success': True,
+        'upload_id': upload_id,
+        'offset': os.path.getsize(_upload_staging_path(upload_id, "part")),
+    }
+    output.update(kwargs)
+    return HttpResponse(json.dumps(output))
+
+@mastr_users_only
+def uploadFileStart(request):
+    """
+    Begins a chunked upload of an experiment file. The file is sent in
+    pieces to uploadFileChunk, and moved into place by
+    uploadFileCommit. An interrupted upload can be resumed from the
+    offset given by uploadFileStatus.
+    """
+    if not request.POST:
+        return HttpResponseBadRequest("POST method only")
+
+    args = request.POST
+    exp = get_object_or_404(Experiment, id=args.get('experimentId'))
+    name = os.path.basename(args.get('name', '')).replace(' ', '_')
+    if not name or name in ('.', '..'):
+        return HttpResponse(json.dumps({"success": False, "msg": "Need to supply a file name"}))
+    try:
+        size = int(args['size']) if args.get('size') else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid size")
+
+    ensure_repo_filestore_dir_with_owner(UPLOAD_STAGING_DIR)
+    _expire_staged_uploads()
+
+    upload_id = uuid.uuid4().hex
+    open(_upload_staging_path(upload_id, "part"), "wb").close()
+    with open(_upload_staging_path(upload_id, "json"), "w") as f:
+        json.dump({
+            'user_id': request.user.id,
+            'experiment_id': exp.id,
+            'parent_folder': args.get('parentId', ''),
+            'name': name,
+            'size': size,
+        }, f)
+
+    return _upload_response(upload_id)
+
+@mastr_users_only
+def uploadFileStatus(request):
+    "Tells the client how much of an upload has arrived."
+    upload_id, upload = _staged_upload(request)
+    return _upload_response(upload_id, size=upload['size'])
+
+@mastr_users_only
+def uploadFileChunk(request):
+    """
+    Writes a chunk of an upload at the given offset. Chunks may be
+    sent again, but not past the end of what has arrived so far.
+    """
+    if not request.POST:
+        return HttpResponseBadRequest("POST method only")
+
+    upload_id, upload = _staged_upload(request)
+    chunk = request.FILES.get('chunk')
+    try:
+        offset = int(request.POST.get('offset', ''))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid offset")
+    if chunk is None:
+        return HttpResponseBadRequest("Need to supply a chunk")
+
+    part = _upload_staging_path(upload_id, "part")
+    received = os.path.getsize(part)
+    if offset < 0 or offset > received:
+        return _upload_response(upload_id, success=False, msg="Expected offset %d" % received)
+    if upload['size'] is not None and offset + chunk.size > upload['size']:
+        return _upload_response(upload_id, success=False, msg="Upload is larger than its size")
+
+    with open(part, "r+b") as f:
+        f.seek(offset)
+        for data in chunk.chunks():
+            f.write(data)
+        if offset + chunk.size < received:
+            f.truncate()
+
+    return _upload_response(upload_id)
+
+@mastr_users_only
+def uploadFileCommit(request):
+    "Moves a completed upload into the experiment's files."
+    if not request.POST:
+        return HttpResponseBadRequest("POST method only")
+
+    upload_id, upload = _staged_upload(request)
+    part = _upload_staging_path(upload_id, "part")
+    received = os.path.getsize(part)
+    if upload['size'] is not None and received != upload['size']:
+        return _upload_response(upload_id, success=False, msg="Upload is incomplete")
+
+    exp = get_object_or_404(Experiment, id=upload['experiment_id'])
+    exp.ensure_dir()
+    dest_dir = real_file_path(exp, upload['parent_folder']) if upload['parent_folder'] else None
+    dest_dir = dest_dir or exp.other_files_dir
+    dest = os.path.join(dest_dir, upload['name'])
+    if not os.path.isdir(dest_dir):
+        return _upload_response(upload_id, success=False, msg="Folder doesn't exist")
+
+    logger.debug('committing upload %s to %s' % (upload_id, dest))
+    set_repo_file_ownerships(part, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IWGRP)
+    os.rename(part, dest)
+    os.remove(_upload_staging_path(upload_id, "json"))
+
+    return HttpResponse(json.dumps({'success': True, 'size': received}))
+
 @mastr_users_only
 def newFolder(request):
     if not request.POST:
@@ -2212,25 +2439,64 @@ class CSVUploadViewFile(CSVUploadView):
                    "num_created": 0,
                    "num_updated": 0 }
 
-        for sid, label, weight, comment in _read_uploaded_sample_csv(csvfile, output):
+        rows = _read_uploaded_sample_csv(csvfile, output)
+        with transaction.atomic():
+            while True:
+                batch = list(islice(rows, SAMPLE_CSV_BATCH_SIZE))
+                if not batch:
+                    break
+                cls.save_samples(batch, experiment, output)
+
+        return output
+
+    @classmethod
+    def save_samples(cls, rows, experiment, output):
+        """
+        Creates or updates the samples for a batch of CSV rows, with
+        one query to find which sample ids exist in the experiment.
+        """
+        ids = [sid for sid, label, weight, comment in rows if sid]
+        existing = set(Sample.objects.filter(experiment=experiment, id__in=ids).values_list("id", flat=True))
+
+        created = []
+        updated = {}
+        for sid, label, weight, comment in rows:
             # If a valid sample id is provided, try to update exising
             # sample, otherwise create a new one.
-            samples = Sample.objects.filter(experiment=experiment, id=sid)
-            if sid and len(samples) == 1:
-                s = samples[0]
+            if sid in existing:
+                s = updated.setdefault(sid, Sample(id=sid, weight=None))
                 output["num_updated"] += 1
             else:
-                s = Sample()
+                s = Sample(experiment=experiment)
+                created.append(s)
                 output["num_created"] += 1
 
             s.label = label
             if weight is not None:
                 s.weight = weight
             s.comment = comment
-            s.experiment = experiment
-            s.save()
 
-        return output
+        Sample.objects.bulk_create(created)
+        _update_samples_from_csv(updated.values())
+
+# Number of CSV rows which are read before their samples are saved.
+SAMPLE_CSV_BATCH_SIZE = 500
+# Number of samples changed by each UPDATE statement.
+SAMPLE_UPDATE_BATCH_SIZE = 100
+
+def _update_samples_from_csv(samples):
+    """
+    Saves the label, comment and weight of existing samples, with one
+    UPDATE per batch. A weight of None leaves the weight unchanged.
+    """
+    for start in range(0, len(samples), SAMPLE_UPDATE_BATCH_SIZE):
+        batch = samples[start:start + SAMPLE_UPDATE_BATCH_SIZE]
+        values = {}
+        for attr in ("label", "comment", "weight"):
+            whens = [When(id=s.id, then=Value(getattr(s, attr))) for s in batch
+                     if getattr(s, attr) is not None]
+            values[attr] = Case(*whens, default=F(attr), output_field=Sample._meta.get_field(attr))
+        Sample.objects.filter(id__in=[s.id for s in batch]).update(**values)
 
 class CSVUploadViewCaptureCSV(CSVUploadView):
     file_field_name = 'runcapturecsv'
@@ -2256,17 +2522,10 @@ class CSVUploadViewCaptureCSV(CSVUploadView):
         """
         Read a file object of CSV text and create RunSample instances from it.
         Returns a "success" dict suitable for returning to the client.
-        """
-        run = Run(
-            method = method,
-            creator = user,
-            title = title,
-            experiment = experiment,
-            machine = machine,
-            state = RUN_STATES.NEW[0],
-            )
-        run.save()
 
+        The whole file is checked before anything is saved, then the
+        run and its samples are created in one transaction.
+        """
         output = {
             "success" : True,
             "num_created" : 0
@@ -2274,11 +2533,25 @@ class CSVUploadViewCaptureCSV(CSVUploadView):
 
         try:
             # sample_id ignored for now.. probably could be got rid of
-            run_samples = []
-            for sample_id, filename in _read_uploaded_run_capture_csv(csvfile, output):
-                rs = RunSample(run=run, filename=filename)
-                output['num_created'] += 1
-                rs.save()
+            filenames = [filename for sample_id, filename in _read_uploaded_run_capture_csv(csvfile, output)]
+            output['num_created'] = len(filenames)
+            if output['success'] and not filenames:
+                # an empty run would be counted as already complete
+                output.update({ "success": False, "msg": "No files were found in the CSV" })
+            if output['success']:
+                with transaction.atomic():
+                    run = Run(
+                        method = method,
+                        creator = user,
+                        title = title,
+                        experiment = experiment,
+                        machine = machine,
+                        state = RUN_STATES.NEW[0],
+                        )
+                    run.save()
+                    RunSample.objects.bulk_create([RunSample(run=run, filename=filename)
+                                                   for filename in filenames])
+                    run.update_sample_counts()
         except ClientLookupException, e:
             output = e.output
         except Exception, e:
@@ -2287,9 +2560,6 @@ class CSVUploadViewCaptureCSV(CSVUploadView):
                 "msg" : str(e)
             }
 
-        # examine output, if we've failed destroy the Run we created
-        if not output['success']:
-            run.delete()
         return output
 
 def _read_uploaded_run_capture_csv(csvfile, output):
@@ -2438,10 +2708,10 @@ def sample_class_enable(request, id):
 
     sc.save()
 
-    return recordsSampleClasses(request, sc.experiment.id)
+    return recordsSampleClasses(request, sc.experiment_id)
 
-def json_error(msg='Unknown error'):
-    return HttpResponse(json.dumps({'success': False, 'msg': msg}))
+def json_error(msg='Unknown error', status=200):
+    return HttpResponse(json.dumps({'success': False, 'msg': msg}), status=status)
 
 @mastr_users_only
 def get_rule_generator(request):
@@ -2453,6 +2723,42 @@ def get_rule_generator(request):
 
     return HttpResponse(json.dumps({'success':True, 'rulegenerator': rulegenerators.convert_to_dict(rg)}))
 
+# the largest run which can be previewed
+PREVIEW_MAX_SAMPLES = 10000
+PREVIEW_MAX_METHODS = 10
+
+@mastr_users_only
+def preview_rule_generator(request):
+    """
+    Shows the worklist which a rule generator would produce for a run
+    with the given number of samples and methods, without creating
+    anything.
+    """
+    from runbuilder import PreviewLayout
+
+    rulegen_id = request.REQUEST.get('id')
+    try:
+        rg = RuleGenerator.objects.get(pk=rulegen_id)
+    except ObjectDoesNotExist:
+        return json_error("Rulegenerator with id %s doesn't exist" % rulegen_id)
+
+    try:
+        sample_count = int(request.REQUEST.get('sample_count', 0))
+        number_of_methods = int(request.REQUEST.get('number_of_methods') or 1)
+        order_of_methods = int(request.REQUEST.get('order_of_methods') or 1)
+    except ValueError:
+        return json_error("Invalid number of samples or methods", status=400)
+    if not 0 < sample_count <= PREVIEW_MAX_SAMPLES:
+        return json_error("The number of samples must be between 1 and %d" % PREVIEW_MAX_SAMPLES, status=400)
+    if not 0 < number_of_methods <= PREVIEW_MAX_METHODS:
+        return json_error("The number of methods must be between 1 and %d" % PREVIEW_MAX_METHODS, status=400)
+    if order_of_methods not in dict(Run.METHOD_ORDERS):
+        return json_error("Invalid order of methods", status=400)
+
+    layout = PreviewLayout(rg, number_of_methods, order_of_methods)
+    worklist = layout.preview(sample_count)
+    return HttpResponse(json.dumps({'success':True, 'worklist': worklist, 'total': len(worklist)}))
+
 @mastr_users_only
 def create_rule_generator(request):
 
@@ -2577,9 +2883,10 @@ def _display_worklist_csv(request, run, samples):
 def mark_run_complete(request, run_id):
     samples = RunSample.objects.filter(run__id=run_id)
 
-    for sample in samples:
-        sample.complete = True
-        sample.save()
+    with deferred_sample_counts():
+        for sample in samples:
+            sample.complete = True
+            sample.save()
 
     run = Run.objects.get(id=run_id)
     run.state = RUN_STATES.COMPLETE[0]
@@ -2634,7 +2941,7 @@ def add_samples_to_run(request):
     #in the order specified by the sample_ids list. We will need to
     #reorder it before we send it to the run for processing.
     #we do this later (see below)
-    queryset = Sample.objects.filter(id__in=sample_ids)
+    queryset = Sample.objects.filter(id__in=sample_ids).select_related("sample_class", "experiment")
     logger.debug("Samples to add to run: %s" % (str(sample_ids) ) )
     if len(queryset) != len(sample_ids):
         return HttpResponseNotFound("At least one of the samples can not be found.\n")
@@ -2647,9 +2954,8 @@ def add_samples_to_run(request):
     # isn't already a PM.
 
     samples = Sample.objects.filter(Q(experiment__users=request.user)|Q(experiment__project__managers=request.user))
-    allowed_set = set(list(samples))
-    qs_set = set(list(queryset))
-    if not qs_set.issubset(allowed_set):
+    allowed_count = samples.filter(id__in=sample_ids).distinct().count()
+    if allowed_count != len(queryset):
         return HttpResponseForbidden('Some samples do not belong to this user.\n')
 
     # check that each sample is valid
@@ -2663,14 +2969,8 @@ def add_samples_to_run(request):
     # by the time you we get here we should have a valid run and valid samples
     #the samples aren't necessarily in the correct order though, because of the call to filter (they are returned in order of database id, not the sequence given in the passed in id list)
     #so we will make a list that is in the correct order
-    sampleslist = []
-    for id in sample_ids:
-        try:
-            #any sample not found in the qs is ignored by
-            #this try catch
-            sampleslist.append(queryset.get(id=id) )
-        except Exception, e:
-            logger.debug("Adding sample %d to list failed: %s" % (id, e))
+    samples_by_id = dict((s.id, s) for s in queryset)
+    sampleslist = [samples_by_id[id] for id in sample_ids if id in samples_by_id]
     logger.debug("Actually adding the samples to the samplelist")
     run.add_samples(sampleslist)
     logger.debug("Finished adding the samples to the samplelist")
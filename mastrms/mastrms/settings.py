@@ -306,4 +306,19 @@ CHMOD_GROUP = env.get("repo_group", "apache")
 REPO_FILES_ROOT = env.get("repo_files_root", os.path.join(CCG_WRITEABLE_DIRECTORY, 'files'))
 QUOTE_FILES_ROOT = env.get("quote_files_root", os.path.join(CCG_WRITEABLE_DIRECTORY, 'quotes'))
 
+# Seconds for which a process trusts that a repo directory it has
+# already created and chowned is still set up correctly.
+REPO_DIR_CACHE_TTL = env.get("repo_dir_cache_ttl", 300)
+
+# Whether download packages are built in a worker thread, so that
+# compressing them overlaps with sending them.
+DOWNLOAD_PACKAGE_THREADED = env.get("download_package_threaded", False)
+
+# How repository files are downloaded. If blank, Django sends them.
+# "x-sendfile" has the web server send them (eg. Apache mod_xsendfile),
+# as does "x-accel-redirect" for nginx, which needs an internal location
+# at DOWNLOAD_ACCEL_REDIRECT_PREFIX aliased to /.
+DOWNLOAD_SENDFILE = env.get("download_sendfile", "")
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = env.get("download_accel_redirect_prefix", "/protected")
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-#
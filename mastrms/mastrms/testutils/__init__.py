@@ -5,7 +5,7 @@ from testcases import NonFlushingTransactionTestCaseMixin
 from mastrms.repository.models import *
 from mastrms.users.models import User
 
-__all__ = ["MockLoggingHandler", "XDisplayTest", "WithFixtures",
+__all__ = ["MockLoggingHandler", "XDisplayTest", "WithFixtures", "WithRun",
            "NonFlushingTransactionTestCaseMixin"]
 
 class MockLoggingHandler(logging.Handler):
@@ -50,6 +50,34 @@ class XDisplayTest(object):
             cls.vdisplay.stop()
 
 
+class WithRun(object):
+    """
+    TestCase mixin which creates the user, project, experiment and
+    instrument method needed by a run.
+    """
+    def setup_experiment(self, email="runs@example.com"):
+        self.user = User.objects.create(email=email)
+        self.project = Project.objects.create(title="Test Project", client=self.user)
+        self.experiment = Experiment.objects.create(title="Test Experiment",
+                                                    job_number="001",
+                                                    project=self.project)
+        self.method = InstrumentMethod.objects.create(title="Test Case",
+                                                      method_path="/test",
+                                                      method_name="rusty python",
+                                                      creator=self.user)
+        return self.experiment
+
+    def setup_run(self, **kwargs):
+        """
+        Creates a run of the experiment, setting up the experiment
+        first if need be. kwargs are passed on to the Run.
+        """
+        if not hasattr(self, "experiment"):
+            self.setup_experiment()
+        self.run = Run.objects.create(experiment=self.experiment, method=self.method,
+                                      creator=self.user, **kwargs)
+        return self.run
+
 class WithFixtures(object):
     "TestCase mixin to provide fixtures for tests."
     # For some reason, fixtures are required, or else the test case
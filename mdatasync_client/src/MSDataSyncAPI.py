@@ -129,6 +129,7 @@ class MSDataSyncAPI(object):
                                  #it needs to be enabled and then debugged -
                                  #we are still seeing UI lagging behind worker operations
         self.transactionvars = TransactionVars()
+        self.manifest = SyncManifest()
 
     # regard directories containing files which have this string in
     # their filename as being in the process of data collection.
@@ -216,12 +217,14 @@ class MSDataSyncAPI(object):
         #PART 1
         #first, tell the server who we are, and get a response
         server = DataSyncServer(self.config)
-        jsonret = server.requestsync()
+        syncold = self.config.getValue("syncold")
+        jsonret = server.requestsync(self.manifest.get_token(syncold))
 
         if jsonret.get("success", False):
             details = jsonret["details"]
-            files = jsonret["files"]
+            files = self.manifest.update(jsonret, syncold)
         else:
+            self.manifest.reset()
             #if there is an error, bail out by calling the return function
             returnFn(retcode=False, retstring="Sync Initiation failed: %s" % jsonret.get("message", "?"))
 
@@ -524,6 +527,45 @@ class MSDataSyncAPI(object):
             self._isDying = True
 
 
+class SyncManifest(object):
+    """
+    The files which the server wants, kept between syncs so that the
+    server only needs to send what has changed since the last request.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.files = {}
+        self.token = None
+        self.syncold = None
+
+    def get_token(self, syncold):
+        "Returns the token to send to the server, if the manifest is usable."
+        if syncold != self.syncold:
+            return None
+        return self.token
+
+    def update(self, jsonret, syncold):
+        """
+        Applies a request_sync response to the manifest and returns the
+        complete dict of wanted files.
+        """
+        if not jsonret.get("incremental", False):
+            self.files = {}
+
+        # a runsample may have changed filename, so forget it by id
+        changed = set(attrs[1] for attrs in jsonret["files"].itervalues())
+        changed.update(jsonret.get("removed", []))
+        for filename, attrs in self.files.items():
+            if attrs[1] in changed:
+                del self.files[filename]
+
+        self.files.update(jsonret["files"])
+        self.token = jsonret.get("sync_token", None)
+        self.syncold = syncold
+        return dict(self.files)
+
 class MSDSImpl(object):
     '''the implementation of the MSDataSyncAPI'''
     def __init__(self, log, controller):
@@ -865,17 +907,21 @@ class DataSyncServer(object):
 
         return self._jsoncall(self._get_synchub_url(), postvars)
 
-    def requestsync(self):
+    def requestsync(self, sync_token=None):
         """
         Ask server for wanted files.
+        If sync_token is given, only the changes since the request
+        which returned that token are sent.
         Returns a dictionary with keys "success", "message", ...
         This method handles exceptions.
         """
         site = DataSyncSite.from_config(self.config)
-        return self._requestsync(site)
+        return self._requestsync(site, sync_token)
 
-    def _requestsync(self, site):
+    def _requestsync(self, site, sync_token=None):
         syncvars = {"version": VERSION , "sync_completed": self.config.getValue("syncold") }
+        if sync_token:
+            syncvars["sync_token"] = sync_token
         outlog.debug("syncvars are: %s" % syncvars)
 
         url = self._get_requestsync_url(site)